@@ -0,0 +1,201 @@
+"""
+Admission control for the fan-out of composite queries
+
+Every fan-out asks for slots before it runs its member-source tasks, one slot per task
+that runs at the same time. Slots are counted in redis against a global budget, a
+per-user quota and a per-dashboard quota, shared by all workers. Background queries only
+get a share of the global budget so interactive queries keep some capacity at peak load.
+A fan-out that can't get a slot waits in a bounded queue, and is rejected when the queue
+is full or it waited too long.
+
+Limits can be changed from site config, see `get_limits`.
+"""
+
+import time
+from contextlib import contextmanager
+
+import frappe
+from insights_changes.utils import RawCacheKey
+
+INFLIGHT_CACHE_KEY = "insights_changes:admission_inflight"
+WAITING_CACHE_KEY = "insights_changes:admission_waiting"
+# counters expire in case a worker dies before releasing its slots
+INFLIGHT_EXPIRY = 10 * 60
+
+INTERACTIVE = "interactive"
+SCHEDULED = "scheduled"
+EXPORT = "export"
+# share of the global budget each priority class can use
+PRIORITY_SHARES = {INTERACTIVE: 1.0, SCHEDULED: 0.5, EXPORT: 0.25}
+# seconds a fan-out of each priority class waits for a slot
+WAIT_TIMEOUTS = {INTERACTIVE: 10, SCHEDULED: 120, EXPORT: 60}
+POLL_INTERVAL = 0.05
+MAX_POLL_INTERVAL = 0.5
+
+DEFAULT_LIMITS = {
+    "composite_max_inflight_tasks": 64,
+    "composite_max_inflight_tasks_per_user": 16,
+    "composite_max_inflight_tasks_per_dashboard": 24,
+    "composite_max_waiting_queries": 32,
+}
+
+# grants up to ARGV[1] slots, as many as the global, user and dashboard counters allow
+ACQUIRE_SCRIPT = """
+local granted = tonumber(ARGV[1])
+for idx, key in ipairs(KEYS) do
+    local used = tonumber(redis.call("HGET", key, ARGV[idx + 2]) or "0")
+    granted = math.min(granted, tonumber(ARGV[idx + 2 + #KEYS]) - used)
+end
+if granted <= 0 then
+    return 0
+end
+for idx, key in ipairs(KEYS) do
+    redis.call("HINCRBY", key, ARGV[idx + 2], granted)
+    redis.call("EXPIRE", key, ARGV[2])
+end
+return granted
+"""
+
+
+class AdmissionRejectedError(frappe.TooManyRequestsError):
+    pass
+
+
+def get_limits():
+    return {key: int(frappe.conf.get(key) or default) for key, default in DEFAULT_LIMITS.items()}
+
+
+def get_priority():
+    """priority class of the current query, queries outside of a request are scheduled"""
+    if frappe.flags.composite_query_priority:
+        return frappe.flags.composite_query_priority
+    if getattr(frappe.local, "request", None) is None:
+        return SCHEDULED
+    return INTERACTIVE
+
+
+@contextmanager
+def query_priority(priority):
+    """run the composite queries of the block with another priority class"""
+    previous = frappe.flags.composite_query_priority
+    frappe.flags.composite_query_priority = priority
+    try:
+        yield
+    finally:
+        frappe.flags.composite_query_priority = previous
+
+
+def get_dashboard():
+    form_dict = getattr(frappe.local, "form_dict", None) or {}
+    if form_dict.get("dashboard"):
+        return form_dict.get("dashboard")
+    if form_dict.get("dt") == "Insights Dashboard":
+        return form_dict.get("dn")
+
+
+class Admission:
+    """the counters a fan-out is admitted against, captured in the request thread"""
+
+    def __init__(self, user=None, dashboard=None, priority=None):
+        self.user = user or frappe.session.user
+        self.dashboard = dashboard or get_dashboard()
+        self.priority = priority or get_priority()
+        self.limits = get_limits()
+
+    def get_counters(self):
+        """(field, limit) of every counter a slot is taken from"""
+        limits = self.limits
+        share = PRIORITY_SHARES.get(self.priority, PRIORITY_SHARES[EXPORT])
+        counters = [
+            ("global", max(int(limits["composite_max_inflight_tasks"] * share), 1)),
+            (f"user:{self.user}", limits["composite_max_inflight_tasks_per_user"]),
+        ]
+        if self.dashboard:
+            counters.append(
+                (
+                    f"dashboard:{self.dashboard}",
+                    limits["composite_max_inflight_tasks_per_dashboard"],
+                )
+            )
+        return counters
+
+    def try_acquire(self, tasks):
+        counters = self.get_counters()
+        key = RawCacheKey(INFLIGHT_CACHE_KEY)
+        script = key.cache.register_script(ACQUIRE_SCRIPT)
+        return int(
+            script(
+                keys=[key.name] * len(counters),
+                args=[
+                    tasks,
+                    INFLIGHT_EXPIRY,
+                    *(field for field, _ in counters),
+                    *(limit for _, limit in counters),
+                ],
+            )
+        )
+
+    def release(self, slots):
+        key = RawCacheKey(INFLIGHT_CACHE_KEY)
+        pipeline = key.pipeline()
+        for field, _ in self.get_counters():
+            pipeline.hincrby(key.name, field, -slots)
+        pipeline.execute()
+
+    def acquire(self, tasks):
+        """
+        number of slots granted to a fan-out of `tasks` tasks, at least one
+
+        waits for a slot if none is free, raises AdmissionRejectedError when the wait
+        queue is full or the wait times out
+        """
+        if slots := self.try_acquire(tasks):
+            return slots
+
+        waiting_key = RawCacheKey(WAITING_CACHE_KEY)
+        waiting = waiting_key.incr()
+        waiting_key.expire(INFLIGHT_EXPIRY)
+        try:
+            if waiting > self.limits["composite_max_waiting_queries"]:
+                self.reject("Too many composite queries are waiting to run")
+
+            deadline = time.monotonic() + WAIT_TIMEOUTS.get(self.priority, 10)
+            interval = POLL_INTERVAL
+            while time.monotonic() < deadline:
+                time.sleep(interval)
+                if slots := self.try_acquire(tasks):
+                    return slots
+                interval = min(interval * 2, MAX_POLL_INTERVAL)
+            self.reject("Timed out waiting for member data source capacity")
+        finally:
+            waiting_key.decr()
+
+    def reject(self, reason):
+        frappe.throw(
+            f"{reason}, please try again in a moment.",
+            AdmissionRejectedError,
+            title="Composite Query Rejected",
+        )
+
+
+@contextmanager
+def admit(admission, tasks):
+    """hold slots for a fan-out of `tasks` member-source tasks, yields the slots granted"""
+    slots = admission.acquire(max(tasks, 1))
+    try:
+        yield slots
+    finally:
+        admission.release(slots)
+
+
+@frappe.whitelist()
+def get_admission_usage():
+    """slots in use per counter, and the number of fan-outs waiting for one"""
+    frappe.only_for("System Manager")
+    inflight = RawCacheKey(INFLIGHT_CACHE_KEY).get_counters(int)
+    waiting = RawCacheKey(WAITING_CACHE_KEY).get()
+    return {
+        "inflight": {field: count for field, count in inflight.items() if count},
+        "waiting": max(int(waiting or 0), 0),
+        "limits": get_limits(),
+    }
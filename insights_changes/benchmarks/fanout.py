@@ -0,0 +1,295 @@
+"""
+Fan-out benchmarks for VirtualDB
+
+Member sources are replaced by synthetic stand-ins backed by local SQLite files, with
+configurable row counts, schema drift between members and injected per-source latency.
+Everything above the member databases (routing, fan-out, merge) is the real code.
+"""
+
+import json
+import os
+import random
+import sqlite3
+import statistics
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+import frappe
+from insights_changes.data_source import VirtualDB
+from insights_changes.utils import bump_schema_version, merge_query_results
+
+BENCH_TABLE = "tabBench Item"
+BENCH_COLUMNS = ("item", "category", "region", "qty", "amount", "posting_date")
+# columns every member has, drift only removes the others
+REQUIRED_COLUMNS = ("item", "qty")
+OPERATIONS = (
+    "run_query",
+    "merge_query_results",
+    "get_insights_table_preview",
+    "get_column_options",
+)
+
+
+class StandInDB:
+    """SQLite backed stand-in for the `db` of a member data source"""
+
+    def __init__(self, path, columns, latency=0.0):
+        self.path = path
+        self.columns = columns
+        self.latency = latency
+
+    def execute_query(
+        self,
+        sql,
+        pluck=False,
+        return_columns=False,
+        replace_query_tables=False,
+        is_native_query=False,
+    ):
+        if self.latency:
+            time.sleep(self.latency)
+
+        with sqlite3.connect(self.path) as connection:
+            cursor = connection.execute(sql)
+            rows = [list(row) for row in cursor.fetchall()]
+            description = cursor.description
+
+        if pluck:
+            return [row[0] for row in rows]
+        if return_columns:
+            return [[{"label": d[0], "type": "String"} for d in description]] + rows
+        return rows
+
+    def build_query(self, query):
+        columns = [col.column for col in query.columns if col.column in self.columns]
+        sql = f"select {', '.join(f'`{c}`' for c in columns)} from `{BENCH_TABLE}`"
+        return sql + (f" limit {query.limit}" if query.get("limit") else "")
+
+    def run_query(self, query):
+        return self.execute_query(self.build_query(query), return_columns=True)
+
+    def get_column_options(self, table, column, search_text=None, limit=50):
+        return self.execute_query(
+            f"select distinct `{column}` from `{table}` limit {int(limit)}", pluck=True
+        )
+
+
+class StandInSource:
+    def __init__(self, name, db):
+        self.name = name
+        self.db = db
+
+
+class BenchmarkVirtualDB(VirtualDB):
+    """VirtualDB whose member sources are stand-ins instead of Insights Data Sources"""
+
+    def __init__(self, source_docs):
+        super().__init__("benchmark")
+        self.source_docs = source_docs
+
+    def get_source_docs(
+        self,
+        get_docs=True,
+        as_generator=False,
+        query=None,
+        skip_unavailable=True,
+        route_replicas=True,
+    ):
+        sources = self.source_docs if get_docs else [doc.name for doc in self.source_docs]
+        self.unavailable_sources = []
+        return iter(sources) if as_generator else list(sources)
+
+    def get_member_table(self, insights_table):
+        return insights_table
+
+    def get_table_column_names(self, insights_table):
+        return ["data_source", *BENCH_COLUMNS]
+
+    def source_has_column(self, source_doc, column):
+        return column in source_doc.db.columns
+
+
+def make_sources(directory, count, rows, drift=0.0, latency=0.0, seed=0):
+    """`count` stand-in members of `rows` rows, optional columns are missing with `drift` odds"""
+    rand = random.Random(seed)
+    sources = []
+    for idx in range(count):
+        columns = [c for c in BENCH_COLUMNS if c in REQUIRED_COLUMNS or rand.random() >= drift]
+        path = os.path.join(directory, f"member_{count}_{rows}_{idx}.sqlite")
+        if os.path.exists(path):
+            os.remove(path)
+        create_member_database(path, columns, rows, rand)
+        sources.append(StandInSource(f"bench-member-{idx}", StandInDB(path, columns, latency)))
+    # members are recreated with other columns, drop sql compiled for the previous ones
+    bump_schema_version(*[source.name for source in sources])
+    return sources
+
+
+def create_member_database(path, columns, rows, rand):
+    values = {
+        "item": lambda i: f"ITEM-{i:07d}",
+        "category": lambda i: f"Category {rand.randint(1, 20)}",
+        "region": lambda i: rand.choice(("North", "South", "East", "West")),
+        "qty": lambda i: rand.randint(1, 100),
+        "amount": lambda i: round(rand.uniform(1, 10000), 2),
+        "posting_date": lambda i: f"2023-{rand.randint(1, 12):02d}-{rand.randint(1, 28):02d}",
+    }
+    with sqlite3.connect(path) as connection:
+        connection.execute(
+            f"create table `{BENCH_TABLE}` ({', '.join(f'`{c}`' for c in columns)})"
+        )
+        connection.executemany(
+            f"insert into `{BENCH_TABLE}` values ({', '.join('?' * len(columns))})",
+            ([values[c](i) for c in columns] for i in range(rows)),
+        )
+
+
+def make_query(limit=None):
+    return frappe._dict(
+        name="benchmark",
+        tables=[],
+        filters=None,
+        limit=limit,
+        columns=[
+            frappe._dict(column=c, label=c, table=BENCH_TABLE, aggregation=None)
+            for c in BENCH_COLUMNS
+        ],
+    )
+
+
+def get_operations(db, query):
+    source_results = [(doc.name, doc.db.run_query(query)) for doc in db.source_docs]
+    return {
+        "run_query": lambda: db.run_query(query),
+        "merge_query_results": lambda: merge_query_results(source_results, query),
+        "get_insights_table_preview": lambda: db.get_insights_table_preview(BENCH_TABLE),
+        "get_column_options": lambda: db.get_column_options(BENCH_TABLE, "category"),
+    }
+
+
+def get_result_rows(operation, out):
+    if operation == "get_insights_table_preview":
+        return len(out["data"])
+    if operation == "get_column_options":
+        return len(out)
+    return max(len(out) - 1, 0)
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    idx = min(int(round(pct / 100 * (len(values) - 1))), len(values) - 1)
+    return values[idx]
+
+
+def measure(fn, repeat):
+    timings = []
+    out = None
+    # every run is timed end to end, not served from prewarmed or stored results
+    frappe.flags.skip_composite_result_caches = True
+    try:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            out = fn()
+            timings.append(time.perf_counter() - start)
+
+        # separate run, tracemalloc slows down the timed runs
+        tracemalloc.start()
+        fn()
+        _, peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    finally:
+        frappe.flags.skip_composite_result_caches = False
+    return timings, peak_memory, out
+
+
+def run_benchmarks(
+    source_counts=(1, 10, 40),
+    row_counts=(100, 10000),
+    drift=0.2,
+    latency=0.0,
+    repeat=5,
+    operations=OPERATIONS,
+    directory=None,
+):
+    directory = directory or tempfile.mkdtemp(prefix="insights_changes_bench_")
+    results = []
+    for count in source_counts:
+        for rows in row_counts:
+            db = BenchmarkVirtualDB(make_sources(directory, count, rows, drift, latency))
+            available = get_operations(db, make_query())
+            for operation in operations:
+                timings, peak_memory, out = measure(available[operation], repeat)
+                result_rows = get_result_rows(operation, out)
+                median = statistics.median(timings)
+                results.append(
+                    {
+                        "operation": operation,
+                        "sources": count,
+                        "rows_per_source": rows,
+                        "result_rows": result_rows,
+                        "p50": median,
+                        "p90": percentile(timings, 90),
+                        "p99": percentile(timings, 99),
+                        "mean": statistics.mean(timings),
+                        "peak_memory": peak_memory,
+                        "rows_per_second": result_rows / median if median else None,
+                    }
+                )
+
+    return {
+        "commit": get_commit(),
+        "timestamp": time.time(),
+        "params": {
+            "drift": drift,
+            "latency": latency,
+            "repeat": repeat,
+        },
+        "results": results,
+    }
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(__file__),
+            stderr=subprocess.DEVNULL,
+            text=True,
+        ).strip()
+    except Exception:
+        return None
+
+
+def compare(base, head, threshold=0.1):
+    """p50 changes between two benchmark runs; regressions are changes above `threshold`"""
+    key = lambda r: (r["operation"], r["sources"], r["rows_per_source"])  # noqa: E731
+    base_results = {key(r): r for r in base["results"]}
+    changes = []
+    for result in head["results"]:
+        if not (previous := base_results.get(key(result))) or not previous["p50"]:
+            continue
+        change = (result["p50"] - previous["p50"]) / previous["p50"]
+        changes.append(
+            {
+                "operation": result["operation"],
+                "sources": result["sources"],
+                "rows_per_source": result["rows_per_source"],
+                "base_p50": previous["p50"],
+                "head_p50": result["p50"],
+                "change": change,
+                "regression": change > threshold,
+            }
+        )
+    return changes
+
+
+def write_results(results, path):
+    with open(path, "w") as f:
+        json.dump(results, f, indent=1)
+
+
+def load_results(path):
+    with open(path) as f:
+        return json.load(f)
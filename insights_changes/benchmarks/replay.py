@@ -0,0 +1,228 @@
+"""
+Replay of captured composite query workloads
+
+Every captured query is re-run through VirtualDB against SQLite stand-ins shaped like its
+table: one stand-in member per source it was routed to, with the columns the query uses
+and synthetic rows. Group by columns, aggregations, sorting and limits are replayed,
+filters and joins are not. Member latency can be injected like in the fan-out benchmarks.
+"""
+
+import concurrent.futures
+import os
+import random
+import sqlite3
+import statistics
+import tempfile
+import time
+
+import frappe
+from insights_changes.benchmarks.fanout import (
+    BenchmarkVirtualDB,
+    StandInDB,
+    StandInSource,
+    get_commit,
+    percentile,
+)
+from insights_changes.utils import bump_schema_version
+
+AGGREGATIONS = ("sum", "avg", "min", "max")
+
+
+class ReplayDB(StandInDB):
+    """stand-in member holding one table, building sql from the shape of a query"""
+
+    def __init__(self, path, table, columns, latency=0.0):
+        super().__init__(path, columns, latency)
+        self.table = table
+
+    def build_query(self, query):
+        select = []
+        group_by = []
+        order_by = []
+        for col in query.columns:
+            if col.column == "data_source":
+                continue
+            column = f"`{col.column}`" if col.column in self.columns else "NULL"
+            aggregation = (col.aggregation or "").lower().replace("_", " ")
+            if aggregation == "group by" or not aggregation:
+                expression = column
+                if aggregation:
+                    group_by.append(str(len(select) + 1))
+            elif aggregation in AGGREGATIONS:
+                expression = f"{aggregation}({column})"
+            elif aggregation == "distinct count":
+                expression = f"count(distinct {column})"
+            else:
+                expression = "count(*)"
+            select.append(f"{expression} as `{col.label or col.column}`")
+            if (col.get("order_by") or "").lower() in ("asc", "desc"):
+                order_by.append(f"{len(select)} {col.order_by}")
+
+        sql = f"select {', '.join(select) or '*'} from `{self.table}`"
+        if group_by:
+            sql += f" group by {', '.join(group_by)}"
+        if order_by:
+            sql += f" order by {', '.join(order_by)}"
+        if query.get("limit"):
+            sql += f" limit {int(query.limit)}"
+        return sql
+
+
+class ReplayVirtualDB(BenchmarkVirtualDB):
+    def get_table_column_names(self, insights_table):
+        columns = self.source_docs[0].db.columns if self.source_docs else []
+        return ["data_source", *columns]
+
+
+def make_value(column_type, rand):
+    column_type = (column_type or "").lower()
+    if column_type in ("integer", "int"):
+        return rand.randint(1, 1000)
+    if column_type in ("decimal", "float"):
+        return round(rand.uniform(1, 10000), 2)
+    if column_type in ("date", "datetime"):
+        return f"2023-{rand.randint(1, 12):02d}-{rand.randint(1, 28):02d}"
+    # text values repeat, like the dimensions charts group by
+    return f"Value {rand.randint(1, 50)}"
+
+
+def get_shape(entry):
+    """(table, ((column, type), ...)) of the stand-in members of a captured query"""
+    definition = entry["definition"]
+    tables = definition.get("tables") or [{}]
+    table = tables[0].get("table") or "tabReplay"
+    columns = {}
+    for col in definition.get("columns") or []:
+        if col.get("column") and col["column"] not in ("data_source", "*", "count"):
+            columns.setdefault(col["column"], col.get("type"))
+    return table, tuple(columns.items())
+
+
+def make_sources(directory, shape, count, rows, latency, seed=0):
+    table, columns = shape
+    rand = random.Random(seed)
+    name = frappe.generate_hash(length=8)
+    sources = []
+    for idx in range(count):
+        path = os.path.join(directory, f"replay_{name}_{idx}.sqlite")
+        with sqlite3.connect(path) as connection:
+            names = [column for column, _ in columns] or ["id"]
+            connection.execute(
+                f"create table `{table}` ({', '.join(f'`{c}`' for c in names)})"
+            )
+            connection.executemany(
+                f"insert into `{table}` values ({', '.join('?' * len(names))})",
+                (
+                    [make_value(column_type, rand) for _, column_type in columns] or [i]
+                    for i in range(rows)
+                ),
+            )
+        db = ReplayDB(path, table, [column for column, _ in columns], latency)
+        sources.append(StandInSource(f"replay-member-{name}-{idx}", db))
+    bump_schema_version(*[source.name for source in sources])
+    return sources
+
+
+def make_query(entry):
+    definition = entry["definition"]
+    return frappe._dict(
+        name=definition.get("name") or entry["digest"],
+        # no tables: members get the query as is, without the column lookup of real members
+        tables=[],
+        filters=None,
+        limit=definition.get("limit"),
+        columns=[frappe._dict(col) for col in definition.get("columns") or []],
+    )
+
+
+def prepare(entries, rows=1000, latency=0.0, max_sources=None, directory=None):
+    """(entry, db, query) of every entry, stand-ins are shared by entries of the same shape"""
+    directory = directory or tempfile.mkdtemp(prefix="insights_changes_replay_")
+    dbs = {}
+    prepared = []
+    for entry in entries:
+        if entry["definition"].get("is_native_query"):
+            continue
+        count = max(len(entry.get("sources") or []), 1)
+        if max_sources:
+            count = min(count, max_sources)
+        key = (get_shape(entry), count)
+        if key not in dbs:
+            dbs[key] = ReplayVirtualDB(make_sources(directory, key[0], count, rows, latency))
+        prepared.append((entry, dbs[key], make_query(entry)))
+    return prepared
+
+
+def run_entry(db, query):
+    """duration and {stage: seconds} of one replayed query"""
+    response = frappe.local.response
+    response["composite_traces"] = []
+    frappe.flags.trace_composite_queries = True
+    start = time.perf_counter()
+    try:
+        db.run_query(query)
+    finally:
+        frappe.flags.trace_composite_queries = False
+    duration = time.perf_counter() - start
+
+    stages = {}
+    for trace in response.pop("composite_traces", []):
+        for span in trace["spans"]:
+            stages[span["stage"]] = stages.get(span["stage"], 0) + span["duration"]
+    return duration, stages
+
+
+def replay(entries, concurrency=4, repeat=1, rows=1000, latency=0.0, max_sources=None):
+    prepared = prepare(entries, rows, latency, max_sources) * repeat
+    site = str(frappe.local.site)
+    durations = []
+    stages = {}
+    errors = 0
+
+    def run(item):
+        frappe.connect(site=site)
+        # replayed queries must not be captured again, nor served from result caches
+        frappe.local.conf.composite_query_capture = False
+        frappe.flags.skip_composite_result_caches = True
+        try:
+            _, db, query = item
+            return run_entry(db, query)
+        finally:
+            frappe.destroy()
+
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+        for future in concurrent.futures.as_completed(
+            [executor.submit(run, item) for item in prepared]
+        ):
+            try:
+                duration, query_stages = future.result()
+            except Exception:
+                errors += 1
+                continue
+            durations.append(duration)
+            for stage, seconds in query_stages.items():
+                stages[stage] = stages.get(stage, 0) + seconds
+    elapsed = time.perf_counter() - start
+
+    return {
+        "commit": get_commit(),
+        "timestamp": time.time(),
+        "params": {
+            "concurrency": concurrency,
+            "repeat": repeat,
+            "rows": rows,
+            "latency": latency,
+            "max_sources": max_sources,
+        },
+        "queries": len(prepared),
+        "errors": errors,
+        "elapsed": elapsed,
+        "throughput": len(durations) / elapsed if elapsed else None,
+        "p50": percentile(durations, 50) if durations else None,
+        "p90": percentile(durations, 90) if durations else None,
+        "p99": percentile(durations, 99) if durations else None,
+        "mean": statistics.mean(durations) if durations else None,
+        # average seconds per query spent in each stage
+        "stages": {stage: seconds / len(durations) for stage, seconds in stages.items()},
+    }
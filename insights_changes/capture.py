@@ -0,0 +1,62 @@
+"""
+Opt-in capture of composite query executions
+
+With `composite_query_capture` set in site config, every fan-out of VirtualDB.run_query
+is appended as a JSON line to private/insights_changes/query_capture.jsonl: the query
+digest and definition, the member sources it was routed to and the timings of its stages.
+Captured workloads can be replayed against stand-in members with the
+`insights-changes-replay` command.
+"""
+
+import json
+import os
+import threading
+import time
+
+import frappe
+from insights_changes.utils import get_query_definition, get_query_digest, suppress_errors
+
+DEFAULT_MAX_BYTES = 100 * 1024 * 1024
+
+_lock = threading.Lock()
+
+
+def is_capture_enabled():
+    return bool(frappe.conf.get("composite_query_capture"))
+
+
+def get_capture_path():
+    return frappe.get_site_path("private", "insights_changes", "query_capture.jsonl")
+
+
+def capture_query(db, query, source_docs, trace):
+    """append an execution of `query` on the virtual data source of `db` to the capture file"""
+    if not is_capture_enabled():
+        return
+
+    with suppress_errors("Failed to capture composite query"):
+        path = get_capture_path()
+        max_bytes = int(frappe.conf.get("composite_query_capture_max_bytes") or DEFAULT_MAX_BYTES)
+        if os.path.exists(path) and os.path.getsize(path) >= max_bytes:
+            return
+
+        entry = {
+            "timestamp": time.time(),
+            "data_source": db.data_source,
+            "digest": get_query_digest(query),
+            "definition": get_query_definition(query),
+            "sources": [db.get_source_label(doc) for doc in source_docs],
+            "source_names": [doc.name for doc in source_docs],
+            "unavailable_sources": db.unavailable_sources,
+            "duration": trace.duration,
+            "spans": [dict(span) for span in trace.spans],
+        }
+        line = json.dumps(entry, default=str) + "\n"
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with _lock, open(path, "a") as f:
+            f.write(line)
+
+
+def load_capture(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
@@ -0,0 +1,107 @@
+import json
+
+import click
+import frappe
+from frappe.commands import get_site, pass_context
+
+
+def parse_int_list(value):
+    return tuple(int(v) for v in value.split(",") if v.strip())
+
+
+@click.command("insights-changes-benchmark")
+@click.option("--sources", default="1,10,40", help="Comma separated numbers of member sources")
+@click.option("--rows", default="100,10000", help="Comma separated row counts per member source")
+@click.option("--drift", default=0.2, type=float, help="Odds of a member missing a column")
+@click.option("--latency", default=0.0, type=float, help="Injected latency per source, in seconds")
+@click.option("--repeat", default=5, type=int, help="Timed runs per measurement")
+@click.option("--output", help="Write results as JSON to this file")
+@click.option("--compare", "compare_with", help="Compare with results of a previous run")
+@click.option("--threshold", default=0.1, type=float, help="Relative p50 change to flag")
+@pass_context
+def benchmark(context, sources, rows, drift, latency, repeat, output, compare_with, threshold):
+    "Benchmark VirtualDB fan-out and merge against synthetic member sources"
+    from insights_changes.benchmarks.fanout import (
+        compare,
+        load_results,
+        run_benchmarks,
+        write_results,
+    )
+
+    site = get_site(context)
+    frappe.init(site=site)
+    frappe.connect()
+    try:
+        results = run_benchmarks(
+            source_counts=parse_int_list(sources),
+            row_counts=parse_int_list(rows),
+            drift=drift,
+            latency=latency,
+            repeat=repeat,
+        )
+    finally:
+        frappe.destroy()
+
+    if output:
+        write_results(results, output)
+
+    for result in results["results"]:
+        click.echo(
+            "{operation:<28} sources={sources:<4} rows={rows_per_source:<8} "
+            "p50={p50:.4f}s p90={p90:.4f}s p99={p99:.4f}s "
+            "peak={peak_memory}B rows/s={rows_per_second}".format(**result)
+        )
+
+    if compare_with:
+        changes = compare(load_results(compare_with), results, threshold)
+        click.echo(json.dumps(changes, indent=1))
+        if any(change["regression"] for change in changes):
+            raise click.ClickException("Benchmark regressions found")
+
+
+@click.command("insights-changes-replay")
+@click.option("--file", "path", help="Captured queries, defaults to the capture file of the site")
+@click.option("--concurrency", default=4, type=int, help="Queries replayed at the same time")
+@click.option("--repeat", default=1, type=int, help="Times every captured query is replayed")
+@click.option("--rows", default=1000, type=int, help="Rows per stand-in member source")
+@click.option("--latency", default=0.0, type=float, help="Injected latency per source, in seconds")
+@click.option("--max-sources", type=int, help="Cap on the stand-in members of a query")
+@click.option("--limit", type=int, help="Replay only the first captured queries")
+@click.option("--output", help="Write results as JSON to this file")
+@pass_context
+def replay(context, path, concurrency, repeat, rows, latency, max_sources, limit, output):
+    "Replay captured composite queries against stand-in member sources"
+    from insights_changes.benchmarks.fanout import write_results
+    from insights_changes.benchmarks.replay import replay as replay_queries
+    from insights_changes.capture import get_capture_path, load_capture
+
+    site = get_site(context)
+    frappe.init(site=site)
+    frappe.connect()
+    try:
+        entries = load_capture(path or get_capture_path())[:limit]
+        if not entries:
+            raise click.ClickException("No captured queries to replay")
+        results = replay_queries(
+            entries,
+            concurrency=concurrency,
+            repeat=repeat,
+            rows=rows,
+            latency=latency,
+            max_sources=max_sources,
+        )
+    finally:
+        frappe.destroy()
+
+    if output:
+        write_results(results, output)
+
+    click.echo(
+        "queries={queries} errors={errors} throughput={throughput:.2f}/s "
+        "p50={p50:.4f}s p90={p90:.4f}s p99={p99:.4f}s".format(**results)
+    )
+    for stage, seconds in sorted(results["stages"].items()):
+        click.echo(f"{stage:<12} {seconds:.4f}s per query")
+
+
+commands = [benchmark, replay]
@@ -1,45 +1,189 @@
 import concurrent.futures
+import functools
+import hashlib
 import json
 
 import frappe
-import pandas as pd
 from frappe.utils import unique
 from insights.insights.doctype.insights_data_source.sources.base_database import (
     BaseDatabase,
 )
 from insights.insights.query_builders.sql_builder import SQLQueryBuilder
+from insights_changes.admission import Admission, admit
+from insights_changes.capture import capture_query
+from insights_changes.handles import get_member_names, get_source_handles
+from insights_changes.health import (
+    filter_available_sources,
+    is_connection_error,
+    registry,
+    report_unavailable_sources,
+)
+from insights_changes.incremental import run_incremental_query
+from insights_changes.joins import BroadcastHashJoin, get_build_table, get_table_sql
+from insights_changes.pagination import KeysetPaginator, align_rows
+from insights_changes.planner import plan_fan_out
+from insights_changes.prewarm import get_prewarmed_result, record_access
+from insights_changes.replicas import ReplicaRouter
+from insights_changes.result_store import get_stored_result, store_result
+from insights_changes.rollups import answer_from_rollups
+from insights_changes.tracing import QueryTrace, get_result_size
 from insights_changes.utils import (
     apply_query_filters_for_datasource,
-    get_sources_for_virtual,
+    bump_schema_version,
+    DistinctRows,
+    get_compiled_sql,
+    get_distinct_sql,
+    get_query_digest,
+    make_virtual_table_name,
+    merge_execute_results,
     merge_query_results,
     query_with_columns_in_table,
     remove_datasource_filters,
+    report_duplicates_removed,
+    set_compiled_sql,
     set_table_columns_for_df,
+    split_virtual_table_name,
 )
 
 SERIAL_LIMIT = 3
+# number of member sources synced at the same time
+SYNC_CONCURRENCY = 8
+SCHEMA_FINGERPRINT_CACHE_KEY = "insights_changes:schema_fingerprint"
+DROPPED_TABLES_CACHE_KEY = "insights_changes:dropped_tables"
 
 
 class VirtualTableFactory:
-    """Fetchs tables and columns from database and links from doctype"""
+    """Syncs tables and columns of the member sources of a virtual data source"""
 
     def __init__(self, data_source) -> None:
-        ...
+        self.data_source = data_source
 
-    # def sync_tables(self, connection, tables, force=False):
-    #     ...
+    def sync_tables(self, source_docs, tables=None, force=False):
+        """
+        sync member sources in parallel, skipping members whose schema is unchanged
+
+        returns the names of the member sources that were synced
+        """
+        synced = []
+        site = str(frappe.local.site)
+
+        def sync_source(source_doc):
+            frappe.connect(site=site)
+            changed = self.sync_source_tables(source_doc, tables, force)
+            frappe.db.commit()
+            return changed
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=SYNC_CONCURRENCY) as executor:
+            futures = {executor.submit(sync_source, doc): doc.name for doc in source_docs}
+            for future in concurrent.futures.as_completed(futures):
+                source_docname = futures[future]
+                try:
+                    changed = future.result()
+                except Exception:
+                    frappe.log_error(
+                        "Data Source: %r generated an exception: %s"
+                        % (source_docname, frappe.get_traceback(with_context=True)),
+                        "VirtualTableFactory.sync_tables",
+                    )
+                else:
+                    if changed:
+                        synced.append(source_docname)
+
+        # the merged schema of the virtual tables is built from the member tables
+        bump_schema_version(self.data_source)
+        return synced
+
+    def sync_source_tables(self, source_doc, tables=None, force=False):
+        fingerprints = self.get_table_fingerprints(source_doc)
+        previous = frappe.cache().hget(SCHEMA_FINGERPRINT_CACHE_KEY, source_doc.name) or {}
+        changed = [
+            table
+            for table, fingerprint in fingerprints.items()
+            if (not tables or table in tables) and (force or previous.get(table) != fingerprint)
+        ]
+        dropped = [
+            table
+            for table in self.get_synced_tables(source_doc)
+            if (not tables or table in tables) and table not in fingerprints
+        ]
+        if not changed and not dropped:
+            return False
+
+        if changed:
+            source_doc.db.sync_tables(changed, force)
+            previous.update({table: fingerprints[table] for table in changed})
+        self.update_dropped_tables(source_doc, dropped, changed)
+        for table in dropped:
+            previous.pop(table, None)
+        frappe.cache().hset(SCHEMA_FINGERPRINT_CACHE_KEY, source_doc.name, previous)
+        bump_schema_version(source_doc.name)
+        return True
+
+    def get_synced_tables(self, source_doc):
+        """tables of `source_doc` with a visible Insights Table"""
+        return frappe.get_all(
+            "Insights Table",
+            filters={"data_source": source_doc.name, "is_query_based": 0, "hidden": 0},
+            pluck="table",
+        )
 
-    # def get_tables(self, table_names=None):
-    #     ...
+    def update_dropped_tables(self, source_doc, dropped, synced):
+        """
+        hide the Insights Tables of tables dropped from `source_doc`
 
-    # def get_db_tables(self, table_names=None):
-    #     ...
+        they are kept for the queries using them, and shown again if the table comes back
+        """
+        hidden = set(frappe.cache().hget(DROPPED_TABLES_CACHE_KEY, source_doc.name) or [])
+        restored = hidden.intersection(synced)
 
-    # def get_table(self, table_name):
-    #     ...
+        def set_hidden(table, value):
+            frappe.db.set_value(
+                "Insights Table",
+                {"data_source": source_doc.name, "table": table, "is_query_based": 0},
+                "hidden",
+                value,
+            )
 
-    # def get_table_columns(self, table_name):
-    #     ...
+        for table in dropped:
+            set_hidden(table, 1)
+        for table in restored:
+            set_hidden(table, 0)
+        hidden = hidden.union(dropped).difference(restored)
+        if hidden:
+            frappe.cache().hset(DROPPED_TABLES_CACHE_KEY, source_doc.name, sorted(hidden))
+        else:
+            frappe.cache().hdel(DROPPED_TABLES_CACHE_KEY, source_doc.name)
+
+    def get_table_fingerprints(self, source_doc):
+        columns = source_doc.db.execute_query(
+            """select table_name, column_name, column_type
+            from information_schema.columns
+            where table_schema = database()
+            order by table_name, ordinal_position"""
+        )
+        digests = {}
+        for table, column, column_type in columns:
+            digest = digests.setdefault(table, hashlib.md5())
+            digest.update(f"{column}:{column_type};".encode())
+        return {table: digest.hexdigest() for table, digest in digests.items()}
+
+    def get_tables(self, source_names, table_names=None):
+        """merged `Insights Table` rows of the member sources, one per table"""
+        filters = {"data_source": ["in", source_names], "is_query_based": 0}
+        if table_names:
+            filters["table"] = ["in", table_names]
+
+        tables = {}
+        for table in frappe.get_all(
+            "Insights Table",
+            filters=filters,
+            fields=["name", "table", "label"],
+            order_by="label asc",
+        ):
+            if table.table not in tables:
+                table.name = make_virtual_table_name(table.name, self.data_source)
+                tables[table.table] = table
+        return list(tables.values())
 
 
 class VirtualDB(BaseDatabase):
@@ -48,79 +192,267 @@ class VirtualDB(BaseDatabase):
         self.data_source_doc = data_source_doc
         self.query_builder: SQLQueryBuilder = SQLQueryBuilder()
         self.table_factory: VirtualTableFactory = VirtualTableFactory(data_source)
+        self.unavailable_sources = []
+        self.router = ReplicaRouter()
 
-    # def sync_tables(self, tables=None, force=False):
-    #     return super().sync_tables(tables, force)
+    def sync_tables(self, tables=None, force=False):
+        # every replica needs its tables, any of them can be routed to
+        source_docs = self.get_source_docs(skip_unavailable=False, route_replicas=False)
+        return self.table_factory.sync_tables(source_docs, tables, force)
 
-    def get_source_docs(self, get_docs=True, as_generator=False, query=None):
-        sources = get_sources_for_virtual(
-            self.data_source_doc or self.data_source, get_docs=get_docs, as_generator=as_generator
+    def get_tables(self, table_names=None):
+        source_names = self.get_source_docs(
+            get_docs=False, skip_unavailable=False, route_replicas=False
         )
-        filtered = apply_query_filters_for_datasource(sources, query)
-        return filtered if as_generator else list(filtered)
-
-    def get_insights_table_preview(self, insights_table, limit=100):
-        db_table = frappe.get_value("Insights Table", insights_table, "table") or insights_table
-        source_docs = self.get_source_docs()
-        results = []
+        return self.table_factory.get_tables(source_names, table_names)
 
-        def get_data_and_length(source_doc):
-            data = source_doc.db.execute_query(
-                f"""select * from `{db_table}` limit {limit}""", return_columns=True
-            )
-            length = source_doc.db.execute_query(f"""select count(*) from `{db_table}`""")[0][0]
-            return data, length
-
-        def run_serial():
-            for source_doc in source_docs:
-                data, length = get_data_and_length(source_doc)
-                results.append((source_doc.name, data, length))
+    def get_source_docs(
+        self,
+        get_docs=True,
+        as_generator=False,
+        query=None,
+        skip_unavailable=True,
+        route_replicas=True,
+    ):
+        # members are resolved from cache, as handles rather than full documents
+        sources = get_member_names(self.data_source_doc or self.data_source)
+        if get_docs:
+            sources = get_source_handles(sources)
+        if route_replicas:
+            # one source per replica group, rows are labelled with the group
+            sources = self.router.route(sources)
+        filtered = apply_query_filters_for_datasource(sources, query, self.get_source_label)
+        self.unavailable_sources = []
+        if skip_unavailable:
+            # sources with an open circuit are skipped instead of waiting for a connect timeout
+            filtered = filter_available_sources(filtered, self.unavailable_sources)
+        if as_generator:
+            return filtered
+
+        filtered = list(filtered)
+        report_unavailable_sources(self.unavailable_sources)
+        return filtered
+
+    def get_source_label(self, source):
+        """value of the `data_source` column for rows of `source`"""
+        return self.router.get_label(source)
+
+    def fan_out(self, trace, source_docs, run, on_result, plan=None):
+        """
+        call `run(source_doc)` on the member sources within the admission budget, and
+        `on_result(source_doc, result)` from the calling thread as results come in
+
+        without a `plan`, a few sources are run serially and more run all at once. Serially
+        run sources raise their errors, concurrently run ones are logged and left out
+        """
+        if plan:
+            tasks = plan.concurrency
+        else:
+            tasks = 1 if len(source_docs) <= SERIAL_LIMIT else len(source_docs)
+        # admitted from the calling thread, the fan-out threads have no session or request
+        with admit(Admission(), tasks) as slots:
+            if slots == 1:
+                for source_doc in source_docs:
+                    on_result(source_doc, run(source_doc))
+                return
 
-        def run_concurrent():
             site = str(frappe.local.site)
+            title = f"VirtualDB.{trace.operation}.run_concurrent"
 
-            def get_data(source_doc):
-                frappe.connect(site=site)
-                data, length = get_data_and_length(source_doc)
-                return data, length
+            def run_batch(batch):
+                with trace.span("connect", batch[0].name if len(batch) == 1 else None):
+                    frappe.connect(site=site)
+                results = []
+                for source_doc in batch:
+                    try:
+                        results.append((source_doc, run(source_doc)))
+                    except Exception:
+                        frappe.log_error(
+                            "Data Source: %r generated an exception: %s"
+                            % (source_doc.name, frappe.get_traceback(with_context=True)),
+                            title,
+                        )
+                return results
 
-            with concurrent.futures.ThreadPoolExecutor() as executor:
-                futures = {executor.submit(get_data, doc): doc.name for doc in source_docs}
+            # sources the plan expects to be cheap share a worker
+            batches = plan.get_batches(slots) if plan else [[doc] for doc in source_docs]
+            with concurrent.futures.ThreadPoolExecutor(slots) as executor:
+                futures = {executor.submit(run_batch, batch): batch for batch in batches}
                 for future in concurrent.futures.as_completed(futures):
-                    source_docname = futures[future]
                     try:
-                        data, length = future.result()
+                        results = future.result()
                     except Exception:
                         frappe.log_error(
-                            "Data source: %r generated an exception: %s"
-                            % (source_docname, frappe.get_traceback(with_context=True)),
-                            "VirtualDB.get_insights_table_preview.run_concurrent",
+                            "Data Sources: %r generated an exception: %s"
+                            % (
+                                [doc.name for doc in futures[future]],
+                                frappe.get_traceback(with_context=True),
+                            ),
+                            title,
                         )
-                    else:
-                        results.append((source_docname, data, length))
+                        continue
+                    for source_doc, result in results:
+                        on_result(source_doc, result)
+
+    def run_on_source(self, source_doc, fn):
+        """
+        call `fn(source_doc)`, recording the outcome in the health registry
+
+        calls that failed to reach the source are retried on another replica of the
+        source, if it has any, errors in the query are raised as they are
+        """
+        tried = []
+        while True:
+            tried.append(source_doc.name)
+            try:
+                with self.router.track(source_doc.name):
+                    out = fn(source_doc)
+            except Exception as e:
+                if not is_connection_error(source_doc.name, e):
+                    raise
+                if registry.record_failure(source_doc.name, e):
+                    self.unavailable_sources.append(source_doc.name)
+                if replica := self.router.get_failover(source_doc, tried):
+                    source_doc = replica
+                    continue
+                raise
+            registry.record_success(source_doc.name)
+            return out
+
+    def get_source_sql(self, source_doc, digest, get_query):
+        """
+        sql of a query on `source_doc`, built once per query digest and member schema version
+
+        `get_query` returns the query without the data source filters, it's only called
+        when the sql isn't cached yet
+        """
+        if (sql := get_compiled_sql(digest, source_doc.name)) is not None:
+            return sql
+        query = query_with_columns_in_table(get_query(), source_doc.name)
+        sql = source_doc.db.build_query(query)
+        set_compiled_sql(digest, source_doc.name, sql)
+        return sql
+
+    def get_source_columns(self, source_doc, digest, get_query):
+        """labels of the columns the sql of a query on `source_doc` returns, cached like it"""
+        key = f"{digest}:columns"
+        if (labels := get_compiled_sql(key, source_doc.name)) is not None:
+            return labels
+        query = query_with_columns_in_table(get_query(), source_doc.name)
+        labels = [col.label for col in query.columns if col.column != "data_source"]
+        set_compiled_sql(key, source_doc.name, labels)
+        return labels
+
+    def get_table_column_names(self, insights_table):
+        """column names of the virtual table, in the order of InsightsTable.columns"""
+        virtual_table = frappe.get_doc(
+            "Insights Table", make_virtual_table_name(insights_table, self.data_source)
+        )
+        return [col.column for col in virtual_table.columns]
 
-        if len(source_docs) <= SERIAL_LIMIT:
-            run_serial()
-        else:
-            run_concurrent()
-
-        total_length = 0
-        df = pd.DataFrame()
-        for source_docname, data, length in results:
-            columns = data.pop(0)
-            column_names = [col["label"] for col in columns]
-            new_df = pd.DataFrame(data)
-            new_df.columns = column_names
-            new_df.insert(0, "data_source", source_docname)
-            df = pd.concat([df, new_df], ignore_index=True)
-            total_length += length
-
-        # ensure columns order match that in InsightsTable.columns
-        df = set_table_columns_for_df(df, insights_table, self.data_source)
-        return {
-            "data": json.loads(df.to_json(orient="values", date_format="iso")),
-            "length": total_length,
-        }
+    def source_has_column(self, source_doc, column):
+        return bool(
+            frappe.db.get_value(
+                "Insights Table",
+                filters=[
+                    ["data_source", "=", source_doc.name],
+                    ["Insights Table Column", "column", "=", column],
+                ],
+            )
+        )
+
+    def get_member_table(self, insights_table):
+        """
+        database table of `insights_table`, a (virtual) Insights Table of a member source
+
+        throws for anything else, the name is used in the sql run on every member
+        """
+        table_name, virtual_data_source = split_virtual_table_name(insights_table)
+        table = frappe.db.get_value(
+            "Insights Table", table_name, ["table", "data_source", "is_query_based"], as_dict=True
+        )
+        members = self.get_source_docs(
+            get_docs=False, skip_unavailable=False, route_replicas=False
+        )
+        if (
+            not table
+            or table.is_query_based
+            or table.data_source not in members
+            or virtual_data_source not in ("", self.data_source)
+        ):
+            frappe.throw(
+                f"Table {insights_table} not found in {self.data_source}", frappe.DoesNotExistError
+            )
+        return table.table
+
+    def get_insights_table_preview(self, insights_table, limit=100, serialize=True):
+        """
+        first `limit` rows of the table on every member source
+
+        with `serialize` off, `data` is a `[columns] + rows` result with the values as
+        returned by the sources, without the round trip through json
+        """
+        with QueryTrace("get_insights_table_preview", self.data_source) as trace:
+            with trace.span("resolve") as span:
+                db_table = self.get_member_table(insights_table)
+                source_docs = self.get_source_docs()
+                span.rows = len(source_docs)
+            results = []
+
+            def _get_data_and_length(source_doc):
+                data = source_doc.db.execute_query(
+                    f"""select * from `{db_table}` limit {limit}""", return_columns=True
+                )
+                length = source_doc.db.execute_query(
+                    f"""select count(*) from `{db_table}`"""
+                )[0][0]
+                return data, length
+
+            def get_data_and_length(source_doc):
+                with trace.span("execute", source_doc.name) as span:
+                    data, length = self.run_on_source(source_doc, _get_data_and_length)
+                    span.rows, span.bytes = get_result_size(data)
+                return data, length
+
+            def add_result(source_doc, out):
+                data, length = out
+                results.append((self.get_source_label(source_doc), data, length))
+
+            self.fan_out(trace, source_docs, get_data_and_length, add_result)
+            report_unavailable_sources(self.unavailable_sources)
+
+            import pandas as pd
+
+            total_length = 0
+            with trace.span("merge") as span:
+                df = pd.DataFrame()
+                for source_docname, data, length in results:
+                    columns = data.pop(0)
+                    column_names = [col["label"] for col in columns]
+                    new_df = pd.DataFrame(data)
+                    new_df.columns = column_names
+                    new_df.insert(0, "data_source", source_docname)
+                    df = pd.concat([df, new_df], ignore_index=True)
+                    total_length += length
+
+                # ensure columns order match that in InsightsTable.columns
+                df = set_table_columns_for_df(df, self.get_table_column_names(insights_table))
+                span.rows = len(df)
+
+            if not serialize:
+                df = df.astype(object).where(df.notna(), None)
+                columns = [{"label": name, "type": "String"} for name in df.columns]
+                return {"data": [columns] + df.values.tolist(), "length": total_length}
+
+            with trace.span("serialize") as span:
+                serialized = df.to_json(orient="values", date_format="iso")
+                span.rows, span.bytes = len(df), len(serialized)
+                data = json.loads(serialized)
+
+            return {
+                "data": data,
+                "length": total_length,
+            }
 
     def execute_query(
         self,
@@ -130,114 +462,293 @@ class VirtualDB(BaseDatabase):
         replace_query_tables=False,
         is_native_query=False,
     ):
-        results = []
-        for source_doc in self.get_source_docs():
-            results.append(
-                source_doc.db.execute_query(
-                    sql, pluck, return_columns, replace_query_tables, is_native_query
-                )
-            )
-        return results
+        with QueryTrace("execute_query", self.data_source) as trace:
+            with trace.span("resolve") as span:
+                source_docs = self.get_source_docs()
+                span.rows = len(source_docs)
 
-    def build_query(self, query):
-        for source_doc in self.get_source_docs(get_docs=True, as_generator=True, query=query):
-            return source_doc.build_query(query)
+            results = []
 
-    def run_query(self, original_query):
-        results = []
-        query = remove_datasource_filters(original_query)
-        source_docs = self.get_source_docs(get_docs=True, query=original_query)
+            def run_source_query(source_doc):
+                with trace.span("execute", source_doc.name) as span:
+                    result = self.run_on_source(
+                        source_doc,
+                        lambda doc: doc.db.execute_query(
+                            sql, pluck, return_columns, replace_query_tables, is_native_query
+                        ),
+                    )
+                    span.rows, span.bytes = get_result_size(result)
+                return result
 
-        def run_serial():
-            for source_doc in source_docs:
-                new_query = query_with_columns_in_table(query, source_doc.name)
-                result = source_doc.db.run_query(new_query)
-                results.append((source_doc.name, result))
+            def add_result(source_doc, result):
+                results.append((self.get_source_label(source_doc), result))
 
-        def run_concurrent():
-            site = str(frappe.local.site)
+            self.fan_out(trace, source_docs, run_source_query, add_result)
 
-            def get_data(source_doc):
-                frappe.connect(site=site)
-                new_query = query_with_columns_in_table(query, source_doc.name)
-                return source_doc.db.run_query(new_query)
+            report_unavailable_sources(self.unavailable_sources)
+            with trace.span("merge") as span:
+                merged = merge_execute_results(results, pluck, return_columns)
+                span.rows, span.bytes = get_result_size(merged)
 
-            with concurrent.futures.ThreadPoolExecutor() as executor:
-                futures = {executor.submit(get_data, doc): doc.name for doc in source_docs}
-                for future in concurrent.futures.as_completed(futures):
-                    source_docname = futures[future]
-                    try:
-                        data = future.result()
-                    except Exception:
-                        frappe.log_error(
-                            "Data Source: %r generated an exception: %s"
-                            % (source_docname, frappe.get_traceback(with_context=True)),
-                            "VirtualDB.run_query.run_concurrent",
-                        )
-                    else:
-                        results.append((source_docname, data))
+            return merged
 
-        if len(source_docs) <= SERIAL_LIMIT:
-            run_serial()
-        else:
-            run_concurrent()
+    def build_query(self, query):
+        for source_doc in self.get_source_docs(get_docs=True, as_generator=True, query=query):
+            return source_doc.build_query(query)
 
-        return merge_query_results(results, query)
+    def run_query(self, original_query, use_result_caches=True):
+        """
+        merged result of `original_query` on every member source
+
+        results are served from the prewarmed, stored and incremental caches unless
+        `use_result_caches` is off, which is how those caches compute their own results
+        """
+        if use_result_caches:
+            record_access(original_query)
+            if (result := get_prewarmed_result(self, original_query)) is not None:
+                return result
+            if (result := get_stored_result(self, original_query)) is not None:
+                return result
+            if original_query.get("incremental_refresh"):
+                result = run_incremental_query(self, original_query)
+                if result is not None:
+                    return result
+
+        with QueryTrace("run_query", self.data_source) as trace:
+            with trace.span("rollup") as span:
+                rollup_result = answer_from_rollups(self, original_query)
+                span.rows, span.bytes = get_result_size(rollup_result)
+            if rollup_result is not None:
+                return rollup_result
+
+            results = []
+            with trace.span("resolve") as span:
+                source_docs = self.get_source_docs(get_docs=True, query=original_query)
+                digest = get_query_digest(original_query)
+                span.rows = len(source_docs)
+
+            @functools.cache
+            def get_query():
+                return remove_datasource_filters(original_query)
+
+            def run_native_query(doc):
+                return doc.db.run_query(query_with_columns_in_table(get_query(), doc.name))
+
+            distinct = original_query.get("distinct_merge")
+
+            def run_compiled_query(doc):
+                with trace.span("compile", doc.name):
+                    sql = self.get_source_sql(doc, digest, get_query)
+                    if sql and distinct:
+                        columns = self.get_source_columns(doc, digest, get_query)
+                        sql = get_distinct_sql(sql, original_query, columns)
+                return doc.db.execute_query(sql, return_columns=True) if sql else []
+
+            def run_source_query(source_doc):
+                if original_query.get("is_native_query"):
+                    fn = run_native_query
+                else:
+                    fn = run_compiled_query
+                with trace.span("execute", source_doc.name) as span:
+                    result = self.run_on_source(source_doc, fn)
+                    span.rows, span.bytes = get_result_size(result)
+                return result
+
+            plan = None
+            if not original_query.get("is_native_query"):
+                with trace.span("plan") as span:
+                    plan = plan_fan_out(
+                        original_query,
+                        source_docs,
+                        lambda doc: self.get_source_sql(doc, digest, get_query),
+                        lambda doc: get_compiled_sql(digest, doc.name),
+                    )
+                    span.rows = plan.total_rows
+                plan.check()
+
+            def add_result(source_doc, result):
+                results.append((self.get_source_label(source_doc), result))
+
+            self.fan_out(trace, source_docs, run_source_query, add_result, plan)
+
+            report_unavailable_sources(self.unavailable_sources)
+            with trace.span("merge") as span:
+                # duplicates across members are dropped as they are merged
+                distinct_rows = DistinctRows() if distinct else None
+                merged = merge_query_results(results, original_query, distinct=distinct_rows)
+                span.rows, span.bytes = get_result_size(merged)
+            if distinct_rows:
+                report_duplicates_removed(distinct_rows.removed)
+
+            if not self.unavailable_sources:
+                with trace.span("store"):
+                    store_result(self, original_query, merged)
+
+        capture_query(self, original_query, source_docs, trace)
+        return merged
+
+    def run_query_page(self, original_query, page_length=None, page_token=None):
+        """
+        a page of the results of `original_query`, fetched with keyset pagination
+
+        returns the page and the token of the next page (None on the last page)
+        """
+        with QueryTrace("run_query_page", self.data_source) as trace:
+            with trace.span("resolve") as span:
+                column_names = [
+                    "data_source" if col.column == "data_source" else col.label
+                    for col in original_query.columns
+                ]
+                paginator = KeysetPaginator(original_query, column_names, page_length, page_token)
+                source_docs = [
+                    doc
+                    for doc in self.get_source_docs(get_docs=True, query=original_query)
+                    if not paginator.is_exhausted(self.get_source_label(doc))
+                ]
+                digest = get_query_digest(original_query, "page")
+                span.rows = len(source_docs)
+            pages = {}
+
+            @functools.cache
+            def get_query():
+                query = remove_datasource_filters(original_query)
+                if query is original_query:
+                    query = frappe.copy_doc(query)
+                # the page length replaces the row limit of the query
+                query.limit = None
+                return query
+
+            def get_page(source_doc):
+                label = self.get_source_label(source_doc)
+
+                def run_page_query(doc):
+                    with trace.span("compile", doc.name):
+                        sql = self.get_source_sql(doc, digest, get_query)
+                        # members without some of the columns page on nulls in their place
+                        columns = self.get_source_columns(doc, digest, get_query)
+                    sql = paginator.get_page_sql(sql, label, columns)
+                    return doc.db.execute_query(sql, return_columns=True)
+
+                with trace.span("execute", source_doc.name) as span:
+                    result = self.run_on_source(source_doc, run_page_query)
+                    span.rows, span.bytes = get_result_size(result)
+                return align_rows(result, column_names, label)
+
+            def add_page(source_doc, page):
+                pages[self.get_source_label(source_doc)] = page
+
+            self.fan_out(trace, source_docs, get_page, add_page)
+
+            report_unavailable_sources(self.unavailable_sources)
+            with trace.span("merge") as span:
+                page = paginator.merge(pages)
+                span.rows = len(page)
+
+            columns = [{"label": col.label, "type": col.type} for col in original_query.columns]
+            return {
+                "data": [columns] + page,
+                "page_token": paginator.encode_token() if paginator.has_more() else None,
+            }
+
+    def broadcast_join(
+        self, insights_table, build_table, probe_key, build_key, how="inner", strategy=None
+    ):
+        """
+        join `insights_table`, read on every member source, with the Insights Table
+        `build_table` of a single data source, read once
+
+        returns the merged result with the `data_source` column first
+        """
+        with QueryTrace("broadcast_join", self.data_source) as trace:
+            with trace.span("resolve") as span:
+                probe_sql = get_table_sql(
+                    split_virtual_table_name(insights_table)[0],
+                    self.get_member_table(insights_table),
+                    probe_key,
+                )
+                build = get_build_table(build_table)
+                build_sql = get_table_sql(build.name, build.table, build_key)
+                join = BroadcastHashJoin(
+                    build.data_source, build_sql, build_key, probe_key, how, strategy
+                )
+                join.build()
+                sql = join.get_probe_sql(probe_sql)
+                source_docs = self.get_source_docs()
+                span.rows = len(join.hash_table)
+            columns = []
+            rows = []
+
+            def probe(source_doc, result):
+                # probed while the other sources are still running
+                if not result:
+                    return
+                label = self.get_source_label(source_doc)
+                with trace.span("merge", label) as span:
+                    if not columns:
+                        columns.extend(join.get_columns(result[0]))
+                    count = len(rows)
+                    for row in join.probe(result[0], result[1:]):
+                        rows.append([label] + row)
+                    span.rows = len(rows) - count
+
+            def run_join_query(source_doc):
+                with trace.span("execute", source_doc.name) as span:
+                    result = self.run_on_source(
+                        source_doc, lambda doc: doc.db.execute_query(sql, return_columns=True)
+                    )
+                    span.rows, span.bytes = get_result_size(result)
+                return result
+
+            self.fan_out(trace, source_docs, run_join_query, probe)
+
+            report_unavailable_sources(self.unavailable_sources)
+            if not columns:
+                return []
+            return [[{"label": "data_source", "type": "String"}] + columns] + rows
 
     # def get_table_columns(self, table):
     #     return super().get_table_columns(table)
 
     def get_column_options(self, table, column, search_text=None, limit=50):
         if column == "data_source":
-            return self.get_source_docs(get_docs=False)
-
-        results = []
-        source_docs = [
-            doc
-            for doc in self.get_source_docs(get_docs=True, as_generator=True)
-            if frappe.db.get_value(
-                "Insights Table",
-                filters=[
-                    ["data_source", "=", doc.name],
-                    ["Insights Table Column", "column", "=", column],
-                ],
-            )
-        ]
-        limit_per_source = max(limit // len(source_docs), 5)
-
-        def get_column_options(source_doc):
-            return source_doc.db.get_column_options(
-                table=table, column=column, search_text=search_text, limit=limit_per_source
-            )
-
-        def run_serial():
-            for source_doc in source_docs:
-                results.extend(get_column_options(source_doc) or [])
-
-        def run_concurrent():
-            site = str(frappe.local.site)
-
-            def get_data(source_doc):
-                frappe.connect(site=site)
-                return get_column_options(source_doc) or []
-
-            with concurrent.futures.ThreadPoolExecutor() as executor:
-                futures = {executor.submit(get_data, doc): doc.name for doc in source_docs}
-                for future in concurrent.futures.as_completed(futures):
-                    source_docname = futures[future]
-                    try:
-                        data = future.result()
-                    except Exception:
-                        frappe.log_error(
-                            "%r generated an exception: %s"
-                            % (source_docname, frappe.get_traceback()),
-                            "get_column_options",
-                        )
-                    else:
-                        results.extend(data)
-
-        if len(source_docs) <= SERIAL_LIMIT:
-            run_serial()
-        else:
-            run_concurrent()
-        return unique(results)
+            sources = self.get_source_docs(get_docs=False, skip_unavailable=False)
+            return unique(self.get_source_label(source) for source in sources)
+
+        with QueryTrace("get_column_options", self.data_source) as trace:
+            results = []
+            with trace.span("resolve") as span:
+                source_docs = [
+                    doc
+                    for doc in self.get_source_docs(get_docs=True, as_generator=True)
+                    if self.source_has_column(doc, column)
+                ]
+                span.rows = len(source_docs)
+            if not source_docs:
+                report_unavailable_sources(self.unavailable_sources)
+                return []
+            limit_per_source = max(limit // len(source_docs), 5)
+
+            def get_column_options(source_doc):
+                with trace.span("execute", source_doc.name) as span:
+                    options = self.run_on_source(
+                        source_doc,
+                        lambda doc: doc.db.get_column_options(
+                            table=table,
+                            column=column,
+                            search_text=search_text,
+                            limit=limit_per_source,
+                        ),
+                    )
+                    span.rows, span.bytes = get_result_size(options)
+                return options
+
+            def add_options(source_doc, options):
+                results.extend(options or [])
+
+            self.fan_out(trace, source_docs, get_column_options, add_options)
+            report_unavailable_sources(self.unavailable_sources)
+            with trace.span("merge") as span:
+                options = unique(results)
+                span.rows = len(options)
+
+            return options
@@ -0,0 +1,34 @@
+from insights_changes.handles import (
+    bump_membership_version,
+    clear_source_handles,
+    get_composites_of,
+)
+from insights_changes.utils import (
+    bump_schema_version,
+    bump_virtual_schema_versions,
+    clear_data_source_exists_cache,
+)
+
+
+def on_insights_table_change(doc, method=None):
+    """member tables feed the merged schema of the virtual tables"""
+    if doc.is_query_based:
+        # not part of the merged schema
+        return
+    bump_schema_version(doc.data_source, *get_composites_of(doc.data_source))
+
+
+def on_data_source_change(doc, method=None, *args):
+    # clear all names, the data source may have been renamed
+    clear_data_source_exists_cache()
+    clear_source_handles()
+    bump_schema_version(doc.name)
+    # membership of (nested) composite data sources may have changed
+    bump_membership_version()
+    bump_virtual_schema_versions()
+
+
+def on_tag_link_change(doc, method=None):
+    if doc.document_type == "Insights Data Source":
+        bump_membership_version()
+        bump_virtual_schema_versions()
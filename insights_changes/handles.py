@@ -0,0 +1,122 @@
+import frappe
+from insights.cache_utils import make_digest
+from insights_changes.utils import get_nested_sources_for_virtual, get_schema_version
+
+HANDLE_CACHE_KEY = "insights_changes:source_handles"
+MEMBERSHIP_VERSION_CACHE_KEY = "insights_changes:membership_version"
+MEMBERS_CACHE_EXPIRY = 24 * 60 * 60
+
+# database objects of member sources, per process: {(site, source): (connection key, db)}
+_databases = {}
+
+
+class SourceHandle:
+    """
+    What the fan-out of a composite query needs of a member data source
+
+    Handles are cached in redis and built in bulk, without loading the documents. The
+    database object of a source is created from its document once per process, and
+    reused for as long as the connection key of the source stays the same.
+    """
+
+    __slots__ = ("name", "database_type", "replica_group", "connection_key")
+
+    def __init__(self, name, database_type=None, replica_group=None, connection_key=None):
+        self.name = name
+        self.database_type = database_type
+        self.replica_group = replica_group
+        self.connection_key = connection_key
+
+    def __repr__(self):
+        return f"<SourceHandle: {self.name}>"
+
+    @property
+    def schema_version(self):
+        return get_schema_version(self.name)
+
+    @property
+    def db(self):
+        key = (frappe.local.site, self.name)
+        cached = _databases.get(key)
+        if cached and cached[0] == self.connection_key:
+            return cached[1]
+
+        db = frappe.get_doc("Insights Data Source", self.name).db
+        _databases[key] = (self.connection_key, db)
+        return db
+
+    def build_query(self, query):
+        return self.db.build_query(query)
+
+    def as_dict(self):
+        return {field: getattr(self, field) for field in self.__slots__}
+
+
+def get_source_handles(source_names):
+    """handles of `source_names` in the same order, the ones not cached are built together"""
+    cached = frappe.cache().hgetall(HANDLE_CACHE_KEY) or {}
+    if missing := [name for name in source_names if name not in cached]:
+        for row in frappe.get_all(
+            "Insights Data Source",
+            filters={"name": ["in", missing]},
+            fields=["name", "database_type", "replica_group", "modified"],
+        ):
+            handle = SourceHandle(
+                row.name,
+                row.database_type,
+                row.replica_group,
+                # saving a data source is the only way to change how it connects
+                make_digest(row.name, str(row.modified)),
+            )
+            cached[row.name] = handle.as_dict()
+            frappe.cache().hset(HANDLE_CACHE_KEY, row.name, cached[row.name])
+
+    return [SourceHandle(**cached[name]) for name in source_names if name in cached]
+
+
+def get_membership_version():
+    """token that changes whenever the members of any composite data source may change"""
+    version = frappe.cache().get_value(MEMBERSHIP_VERSION_CACHE_KEY)
+    if not version:
+        version = bump_membership_version()
+    return version
+
+
+def bump_membership_version():
+    """
+    invalidate the members of every composite data source
+
+    members only change with data sources and their tags, saving a table doesn't change them
+    """
+    version = frappe.generate_hash(length=10)
+    frappe.cache().set_value(MEMBERSHIP_VERSION_CACHE_KEY, version)
+    return version
+
+
+def get_member_names(data_source):
+    """member sources of a composite data source, cached until the membership version changes"""
+    name = data_source if isinstance(data_source, str) else data_source.name
+    key = f"insights_changes:members:{name}:{get_membership_version()}"
+    members = frappe.cache().get_value(key)
+    if members is None:
+        members = sorted(get_nested_sources_for_virtual(data_source)[0])
+        frappe.cache().set_value(key, members, expires_in_sec=MEMBERS_CACHE_EXPIRY)
+    return members
+
+
+def get_composites_of(source):
+    """composite data sources `source` is a member of"""
+    return [
+        name
+        for name in frappe.get_all(
+            "Insights Data Source", filters={"composite_datasource": 1}, pluck="name"
+        )
+        if source in get_member_names(name)
+    ]
+
+
+def clear_source_handles(data_source=None):
+    if data_source:
+        frappe.cache().hdel(HANDLE_CACHE_KEY, data_source)
+    else:
+        frappe.cache().delete_value(HANDLE_CACHE_KEY)
@@ -0,0 +1,189 @@
+import time
+
+import frappe
+import sqlalchemy.exc
+from insights_changes.overrides.functions.is_frappe_db import can_connect
+from insights_changes.utils import RawCacheKey
+
+HEALTH_CACHE_KEY = "insights_changes:source_health"
+# claimed by the one request let through as the trial of a half-open circuit
+TRIAL_CACHE_KEY = "insights_changes:source_trial"
+# reachability of a source, checked when an error could be either the query or the source
+REACHABLE_CACHE_KEY = "insights_changes:source_reachable"
+REACHABLE_CACHE_EXPIRY = 10
+# consecutive failures before the circuit of a source is opened
+FAILURE_THRESHOLD = 3
+# seconds an open circuit waits before letting a trial request through
+OPEN_TIMEOUT = 60
+# errors that always mean the source couldn't be reached
+CONNECTION_ERRORS = (
+    ConnectionError,
+    TimeoutError,
+    sqlalchemy.exc.DisconnectionError,
+    sqlalchemy.exc.InterfaceError,
+)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+class SourceHealthRegistry:
+    """
+    Circuit breaker state for member data sources
+
+    State is kept in redis so every worker (and every thread of a fan-out)
+    shares the same view of which member databases are down.
+    """
+
+    def get(self, source):
+        state = frappe.cache().hget(HEALTH_CACHE_KEY, source)
+        return frappe._dict(state or {"state": CLOSED, "failures": 0})
+
+    def set(self, source, state):
+        frappe.cache().hset(HEALTH_CACHE_KEY, source, dict(state))
+
+    def get_all(self):
+        return {
+            source: frappe._dict(state)
+            for source, state in (frappe.cache().hgetall(HEALTH_CACHE_KEY) or {}).items()
+        }
+
+    def reset(self, source=None):
+        if source:
+            frappe.cache().hdel(HEALTH_CACHE_KEY, source)
+        else:
+            frappe.cache().delete_value(HEALTH_CACHE_KEY)
+
+    def is_available(self, source):
+        health = self.get(source)
+        if health.state == CLOSED:
+            return True
+        if time.time() - (health.opened_at or 0) < OPEN_TIMEOUT:
+            return False
+
+        # only the request that claims the trial goes through, the source is skipped for the
+        # others until it records its outcome, or the claim of a lost trial expires
+        if not self.claim_trial(source):
+            return False
+        health.state = HALF_OPEN
+        self.set(source, health)
+        return True
+
+    def claim_trial(self, source):
+        return bool(RawCacheKey(f"{TRIAL_CACHE_KEY}:{source}").set(1, nx=True, ex=OPEN_TIMEOUT))
+
+    def release_trial(self, source):
+        RawCacheKey(f"{TRIAL_CACHE_KEY}:{source}").delete()
+
+    def record_success(self, source):
+        health = self.get(source)
+        if health.state != CLOSED:
+            self.release_trial(source)
+        if health.state != CLOSED or health.failures:
+            self.set(source, {"state": CLOSED, "failures": 0})
+
+    def record_failure(self, source, error=None):
+        """returns True if this failure opened the circuit"""
+        health = self.get(source)
+        health.failures = (health.failures or 0) + 1
+        health.last_error = str(error)[:500] if error else health.last_error
+
+        opened = health.state == HALF_OPEN or (
+            health.state == CLOSED and health.failures >= FAILURE_THRESHOLD
+        )
+        if opened or health.state == OPEN:
+            health.state = OPEN
+            health.opened_at = time.time()
+        self.set(source, health)
+        # after the circuit is open again, so no other request takes the trial meanwhile
+        self.release_trial(source)
+        return opened
+
+
+registry = SourceHealthRegistry()
+
+
+def get_source_name(source):
+    return source if isinstance(source, str) else source.name
+
+
+def filter_available_sources(sources, unavailable):
+    """yield sources whose circuit is not open, collecting the skipped names in `unavailable`"""
+    for source in sources:
+        name = get_source_name(source)
+        if registry.is_available(name):
+            yield source
+        else:
+            unavailable.append(name)
+
+
+def report_unavailable_sources(sources):
+    """add skipped member sources to the response of the current request"""
+    response = getattr(frappe.local, "response", None)
+    if not sources or response is None:
+        return
+
+    reported = set(response.get("unavailable_sources") or [])
+    reported.update(sources)
+    response["unavailable_sources"] = sorted(reported)
+
+
+def can_connect_source(source):
+    doc = frappe.get_doc("Insights Data Source", source)
+    reachable = bool(can_connect(doc.get_connection_args()))
+    frappe.cache().set_value(
+        f"{REACHABLE_CACHE_KEY}:{source}", reachable, expires_in_sec=REACHABLE_CACHE_EXPIRY
+    )
+    return reachable
+
+
+def is_reachable(source):
+    """can_connect_source, checked at most once every few seconds per source"""
+    reachable = frappe.cache().get_value(f"{REACHABLE_CACHE_KEY}:{source}")
+    return can_connect_source(source) if reachable is None else reachable
+
+
+def is_connection_error(source, error):
+    """
+    whether `error` means `source` is down, rather than the query run on it being wrong
+
+    only these errors count against the health of a source, errors in queries don't
+    """
+    while error is not None:
+        if isinstance(error, CONNECTION_ERRORS) or getattr(error, "connection_invalidated", False):
+            return True
+        if isinstance(error, sqlalchemy.exc.OperationalError):
+            # also raised for errors in the query itself, e.g. unknown columns on mysql
+            return not is_reachable(source)
+        error = error.__cause__ or error.__context__
+    return False
+
+
+def probe_source(source):
+    if can_connect_source(source):
+        registry.record_success(source)
+        return True
+
+    health = registry.get(source)
+    health.state = OPEN
+    health.opened_at = time.time()
+    registry.set(source, health)
+    return False
+
+
+def probe_sources():
+    """scheduled: check sources with a non-closed circuit so they recover without user traffic"""
+    for source, health in registry.get_all().items():
+        if health.state == CLOSED:
+            continue
+        if not frappe.db.exists("Insights Data Source", source):
+            registry.reset(source)
+            continue
+        probe_source(source)
+
+
+@frappe.whitelist()
+def get_source_health():
+    frappe.only_for("System Manager")
+    return registry.get_all()
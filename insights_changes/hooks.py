@@ -116,6 +116,22 @@ override_doctype_class = {
 # 	}
 # }
 
+doc_events = {
+    "Insights Table": {
+        "on_update": "insights_changes.events.on_insights_table_change",
+        "on_trash": "insights_changes.events.on_insights_table_change",
+    },
+    "Insights Data Source": {
+        "on_update": "insights_changes.events.on_data_source_change",
+        "on_trash": "insights_changes.events.on_data_source_change",
+        "after_rename": "insights_changes.events.on_data_source_change",
+    },
+    "Tag Link": {
+        "after_insert": "insights_changes.events.on_tag_link_change",
+        "on_trash": "insights_changes.events.on_tag_link_change",
+    },
+}
+
 # Scheduled Tasks
 # ---------------
 
@@ -137,6 +153,29 @@ override_doctype_class = {
 # 	],
 # }
 
+scheduler_events = {
+    "cron": {
+        "* * * * *": [
+            "insights_changes.health.probe_sources",
+        ],
+        "50 * * * *": [
+            "insights_changes.prewarm.prewarm_queries",
+        ],
+    },
+    "hourly": [
+        "insights_changes.result_store.cleanup_result_store",
+    ],
+    "daily": [
+        "insights_changes.prewarm.decay_access_stats",
+    ],
+    "hourly_long": [
+        "insights_changes.rollups.refresh_hourly_rollups",
+    ],
+    "daily_long": [
+        "insights_changes.rollups.refresh_daily_rollups",
+    ],
+}
+
 # Testing
 # -------
 
@@ -152,6 +191,7 @@ override_whitelisted_methods = {
     "insights.api.get_data_source": "insights_changes.overrides.functions.get_data_source",
     "insights.api.get_tables": "insights_changes.overrides.functions.get_tables",
     "frappe.desk.doctype.tag.tag.add_tag": "insights_changes.overrides.functions.add_tag",
+    "frappe.desk.doctype.tag.tag.remove_tag": "insights_changes.overrides.functions.remove_tag",
     "insights.insights.doctype.insights_dashboard.insights_dashboard.get_queries_column": "insights_changes.overrides.functions.get_queries_column",
 }
 #
@@ -0,0 +1,145 @@
+import json
+
+import frappe
+from frappe.utils import getdate, now_datetime, time_diff_in_seconds
+from insights_changes.rollups import TIME_GRAINS, get_date_format, sort_rows, truncate_date
+from insights_changes.utils import get_query_digest, get_schema_version
+
+# the cached series is rebuilt from scratch once a day, to pick up late changes to old rows
+REBUILD_INTERVAL = 24 * 60 * 60
+
+
+def get_time_column(query):
+    """
+    index and time grain of the column the time series of `query` is bucketed on
+
+    returns None if `query` can't be refreshed incrementally: every row of the result must
+    belong to a single time bucket, and the buckets before the watermark must not change
+    """
+    if query.get("is_native_query") or query.get("limit") or len(query.tables) != 1:
+        return
+
+    time_column = None
+    for idx, col in enumerate(query.columns):
+        if col.get("is_expression"):
+            return
+        aggregation = (col.aggregation or "").lower().replace("_", " ")
+        if not aggregation:
+            # plain rows aren't bucketed
+            return
+        if aggregation == "group by" and (grain := get_date_format(col)) in TIME_GRAINS:
+            if time_column:
+                return
+            time_column = (idx, grain)
+
+    if not time_column:
+        return
+    # relative date filters move the start of the series as well
+    column = query.columns[time_column[0]].column
+    if query.filters and f'"{column}"' in query.filters:
+        return
+    return time_column
+
+
+def get_cache_key(db, query):
+    version = get_schema_version(db.data_source)
+    digest = get_query_digest(query)
+    return f"insights_changes:incremental:{db.data_source}:{version}:{query.name}:{digest}"
+
+
+def add_time_filter(query, watermark):
+    """copy of `query` that only returns rows from `watermark` on"""
+    col = query.columns[get_time_column(query)[0]]
+    condition = {
+        "type": "BinaryExpression",
+        "operator": ">=",
+        "left": {"type": "Column", "value": {"column": col.column, "table": col.table}},
+        "right": {"type": "String", "value": str(watermark)},
+    }
+    filters = frappe.parse_json(query.filters) if query.filters else None
+    if not filters or not filters.get("conditions"):
+        filters = {"type": "LogicalExpression", "operator": "&&", "conditions": []}
+    elif filters.get("operator") != "&&":
+        filters = {"type": "LogicalExpression", "operator": "&&", "conditions": [filters]}
+    filters["conditions"].append(condition)
+
+    new_query = frappe.copy_doc(query)
+    new_query.filters = json.dumps(filters)
+    return new_query
+
+
+def get_row_columns(result, query):
+    """
+    columns of `query` in the order of the rows of a merged `result`
+
+    merged rows start with their data source when the query selects it, the columns of
+    the result are the first member's, without it
+    """
+    header = [col["label"] for col in result[0]] if result else []
+    width = len(result[1]) if len(result) > 1 else len(header)
+    offset = width - len(header)
+    if offset not in (0, 1):
+        # members disagreed on the columns, rows follow the columns of the query
+        return list(query.columns)
+
+    row_columns = [frappe._dict() for _ in range(width)]
+    for col in query.columns:
+        if col.column == "data_source" and offset:
+            row_columns[0] = col
+        elif col.label in header:
+            row_columns[header.index(col.label) + offset] = col
+    return row_columns
+
+
+def replace_tail(cached, tail, time_index, watermark):
+    """rows of `cached` before the `watermark` bucket, followed by the rows of `tail`"""
+    rows = [
+        row
+        for row in cached[1:]
+        if row[time_index] is None or getdate(row[time_index]) < watermark
+    ]
+    rows += tail[1:]
+    return [tail[0] if tail else cached[0]] + rows
+
+
+def run_incremental_query(db, query):
+    """
+    run `query` on the virtual data source of `db`, re-querying only the latest buckets
+
+    the merged series is cached with a watermark, the start of the bucket that was still
+    open when it was fetched. A refresh re-queries every member from the watermark on and
+    replaces the buckets from the watermark on. Returns None if `query` isn't eligible.
+    """
+    if not (time_column := get_time_column(query)):
+        return
+
+    column_index, grain = time_column
+    key = get_cache_key(db, query)
+    cached = frappe.cache().get_value(key)
+    now = now_datetime()
+    watermark = truncate_date(now.date(), grain)
+
+    if cached is None or time_diff_in_seconds(now, cached["built_on"]) > REBUILD_INTERVAL:
+        result = db.run_query(query, use_result_caches=False)
+        built_on = now
+    else:
+        tail = db.run_query(add_time_filter(query, cached["watermark"]), use_result_caches=False)
+        row_columns = get_row_columns(cached["result"], query)
+        time_col = query.columns[column_index]
+        time_index = next(
+            (idx for idx, col in enumerate(row_columns) if col is time_col), column_index
+        )
+        result = replace_tail(cached["result"], tail, time_index, cached["watermark"])
+        result = [result[0]] + sort_rows(result[1:], row_columns)
+        built_on = cached["built_on"]
+
+    # a series that misses unavailable sources isn't cached, the next run starts over
+    if db.unavailable_sources:
+        frappe.cache().delete_value(key)
+    else:
+        frappe.cache().set_value(
+            key,
+            {"watermark": watermark, "built_on": built_on, "result": result},
+            expires_in_sec=REBUILD_INTERVAL,
+        )
+    return result
@@ -0,0 +1,223 @@
+# Copyright (c) 2026, Venco Ltd and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe.model.document import Document
+from frappe.utils import now_datetime
+from insights_changes.rollups import TIME_GRAINS, get_date_format, sort_rows, truncate_date
+from insights_changes.utils import remove_datasource_filters
+
+# grains a rollup of a given grain can be re-aggregated to
+COMPATIBLE_GRAINS = {
+    "Day": TIME_GRAINS,
+    "Week": ("Week",),
+    "Month": ("Month", "Quarter", "Year"),
+    "Quarter": ("Quarter", "Year"),
+    "Year": ("Year",),
+}
+COUNT_COLUMNS = ("", "*", "count")
+
+
+class InsightsRollup(Document):
+    def validate(self):
+        if not frappe.db.get_value(
+            "Insights Data Source", self.data_source, "composite_datasource"
+        ):
+            frappe.throw("Rollups can only be defined on composite data sources")
+
+        for column in [self.table, self.time_column, *self.get_dimensions()] + [
+            m.column for m in self.measures if m.column
+        ]:
+            if "`" in column:
+                frappe.throw(f"Invalid column name: {column}")
+
+    def on_update(self):
+        # stored rows were computed for the previous definition
+        frappe.cache().delete_value(self.get_cache_key())
+        if self.enabled:
+            frappe.enqueue_doc(self.doctype, self.name, "refresh", queue="long")
+
+    def on_trash(self):
+        frappe.cache().delete_value(self.get_cache_key())
+
+    def get_cache_key(self):
+        return f"insights_changes:rollup:{self.name}"
+
+    def get_dimensions(self):
+        return [d.strip() for d in (self.dimensions or "").splitlines() if d.strip()]
+
+    def get_measures(self):
+        """(aggregation, column) of each measure, in the order they are stored"""
+        return [(m.aggregation.lower(), (m.column or "").strip() or "*") for m in self.measures]
+
+    def get_sql(self):
+        time_column = f"`{self.time_column}`"
+        year_start = f"MAKEDATE(YEAR({time_column}), 1)"
+        bucket = {
+            "Day": f"DATE({time_column})",
+            "Week": f"DATE_SUB(DATE({time_column}), INTERVAL WEEKDAY({time_column}) DAY)",
+            "Month": f"DATE_SUB(DATE({time_column}), INTERVAL DAYOFMONTH({time_column}) - 1 DAY)",
+            "Quarter": f"{year_start} + INTERVAL QUARTER({time_column}) - 1 QUARTER",
+            "Year": year_start,
+        }[self.time_grain]
+
+        dimensions = [f"`{d}`" for d in self.get_dimensions()]
+        measures = []
+        for aggregation, column in self.get_measures():
+            column = column if column == "*" else f"`{column}`"
+            if aggregation == "avg":
+                measures += [f"SUM({column})", f"COUNT({column})"]
+            else:
+                measures.append(f"{aggregation.upper()}({column})")
+
+        return f"""select {", ".join([bucket, *dimensions, *measures])}
+            from `{self.table}`
+            group by {", ".join(str(i + 1) for i in range(len(dimensions) + 1))}"""
+
+    def refresh(self):
+        """precompute the rollup on every member source of the data source"""
+        data_source = frappe.get_doc("Insights Data Source", self.data_source)
+        db = data_source.db
+        sql = self.get_sql()
+        for source_doc in db.get_source_docs():
+            try:
+                rows = db.run_on_source(source_doc, lambda doc: doc.db.execute_query(sql))
+            except Exception:
+                frappe.log_error(
+                    "Data Source: %r generated an exception: %s"
+                    % (source_doc.name, frappe.get_traceback(with_context=True)),
+                    "InsightsRollup.refresh",
+                )
+                continue
+            frappe.cache().hset(
+                self.get_cache_key(), db.get_source_label(source_doc), [list(r) for r in rows]
+            )
+
+        self.db_set("last_refreshed_on", now_datetime(), update_modified=False)
+
+    def get_query_plan(self, query):
+        """
+        map the columns of `query` onto the rollup
+
+        returns a list of (kind, value) per query column, or None if the query can't be
+        answered from this rollup
+        """
+        if len(query.tables) != 1 or query.tables[0].table != self.table:
+            return
+        if query.tables[0].get("join") or has_filters(query):
+            return
+
+        dimensions = self.get_dimensions()
+        measures = self.get_measures()
+        plan = []
+        has_measure = False
+        for col in query.columns:
+            if col.get("is_expression"):
+                return
+            aggregation = (col.aggregation or "").lower().replace("_", " ")
+            if aggregation == "group by":
+                if col.column == self.time_column:
+                    grain = get_date_format(col)
+                    if grain not in COMPATIBLE_GRAINS[self.time_grain]:
+                        return
+                    plan.append(("time", grain))
+                elif col.column == "data_source":
+                    plan.append(("data_source", None))
+                elif col.column in dimensions:
+                    plan.append(("dimension", dimensions.index(col.column)))
+                else:
+                    return
+            elif aggregation in ("count", "sum", "min", "max", "avg"):
+                column = col.column
+                if aggregation == "count" and column in COUNT_COLUMNS:
+                    column = "*"
+                if (aggregation, column) not in measures:
+                    return
+                plan.append(("measure", measures.index((aggregation, column))))
+                has_measure = True
+            else:
+                return
+
+        return plan if has_measure else None
+
+    def answer(self, query, source_names):
+        """answer `query` from the stored rows of `source_names`, None if not possible"""
+        plan = self.get_query_plan(query)
+        if plan is None:
+            return
+
+        stored = frappe.cache().hgetall(self.get_cache_key()) or {}
+        if any(source not in stored for source in source_names):
+            return
+
+        measures = self.get_measures()
+        # offset of every measure within a stored row
+        offsets = []
+        offset = 1 + len(self.get_dimensions())
+        for aggregation, _ in measures:
+            offsets.append(offset)
+            offset += 2 if aggregation == "avg" else 1
+
+        groups = {}
+        for source in source_names:
+            for row in stored[source]:
+                key = []
+                for kind, value in plan:
+                    if kind == "time":
+                        key.append(truncate_date(row[0], value))
+                    elif kind == "dimension":
+                        key.append(row[1 + value])
+                    elif kind == "data_source":
+                        key.append(source)
+                key = tuple(key)
+                if key not in groups:
+                    groups[key] = [None] * offset
+                merge_measures(groups[key], row, measures, offsets)
+
+        rows = []
+        for key, values in groups.items():
+            key = iter(key)
+            row = []
+            for kind, value in plan:
+                if kind == "measure":
+                    row.append(get_measure_value(values, measures[value][0], offsets[value]))
+                else:
+                    row.append(next(key))
+            rows.append(row)
+
+        rows = sort_rows(rows, query.columns)
+        if query.get("limit"):
+            rows = rows[: query.limit]
+        columns = [{"label": col.label, "type": col.type} for col in query.columns]
+        return [columns] + rows
+
+
+def has_filters(query):
+    query = remove_datasource_filters(query)
+    filters = frappe.parse_json(query.filters) if query.filters else {}
+    return bool(filters.get("conditions"))
+
+
+def merge_measures(values, row, measures, offsets):
+    for (aggregation, _), offset in zip(measures, offsets):
+        for idx in (offset, offset + 1) if aggregation == "avg" else (offset,):
+            new, current = row[idx], values[idx]
+            if new is None:
+                continue
+            if current is None:
+                values[idx] = new
+            elif aggregation == "min":
+                values[idx] = min(current, new)
+            elif aggregation == "max":
+                values[idx] = max(current, new)
+            else:
+                values[idx] = current + new
+
+
+def get_measure_value(values, aggregation, offset):
+    if aggregation == "avg":
+        total, count = values[offset], values[offset + 1]
+        return total / count if count else None
+    if aggregation == "count":
+        return values[offset] or 0
+    return values[offset]
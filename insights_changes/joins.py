@@ -0,0 +1,124 @@
+import frappe
+from insights.decorators import check_role
+from insights.insights.doctype.insights_team.insights_team import check_data_source_permission
+from insights_changes.pagination import quote
+
+# max number of distinct join keys pushed down to the member sources as an IN list
+BROADCAST_IN_LIMIT = 1000
+
+
+class BroadcastHashJoin:
+    """
+    Joins a large table present in every member source with a small table living in one source
+
+    The small (build) side is fetched once and hashed on its join key. It is pushed down to
+    the members as an `IN` list when that is cheap, and always probed locally against the
+    rows coming back from each member.
+    """
+
+    def __init__(self, build_source, build_sql, build_key, probe_key, how="inner", strategy=None):
+        if how not in ("inner", "left"):
+            frappe.throw(f"Unsupported join type: {how}")
+        if strategy not in (None, "push", "probe"):
+            frappe.throw(f"Unsupported join strategy: {strategy}")
+
+        self.build_source = build_source
+        self.build_sql = build_sql
+        self.build_key = build_key
+        self.probe_key = probe_key
+        self.how = how
+        self.strategy = strategy
+        self.build_columns = []
+        self.hash_table = {}
+
+    def build(self):
+        if isinstance(self.build_source, str):
+            self.build_source = frappe.get_doc("Insights Data Source", self.build_source)
+        if self.build_source.composite_datasource:
+            frappe.throw("The small side of a broadcast join must be a single data source")
+
+        result = self.build_source.db.execute_query(self.build_sql, return_columns=True)
+        self.build_columns = result[0] if result else []
+        key_idx = get_column_index(self.build_columns, self.build_key)
+
+        self.hash_table = {}
+        for row in result[1:]:
+            if row[key_idx] is not None:
+                self.hash_table.setdefault(row[key_idx], []).append(list(row))
+
+        if self.strategy is None:
+            # a left join keeps unmatched rows, so the large side can't be pruned
+            push = self.how == "inner" and len(self.hash_table) <= BROADCAST_IN_LIMIT
+            self.strategy = "push" if push else "probe"
+        return self
+
+    def get_probe_sql(self, probe_sql):
+        if self.strategy != "push":
+            return probe_sql
+        if not self.hash_table:
+            return f"select * from ({probe_sql}) as t where 1 = 0"
+
+        keys = ", ".join(escape_value(key) for key in self.hash_table)
+        return f"select * from ({probe_sql}) as t where t.{quote(self.probe_key)} in ({keys})"
+
+    def get_columns(self, probe_columns):
+        return list(probe_columns) + list(self.build_columns)
+
+    def probe(self, probe_columns, rows):
+        key_idx = get_column_index(probe_columns, self.probe_key)
+        empty = [None] * len(self.build_columns)
+        for row in rows:
+            matches = self.hash_table.get(row[key_idx])
+            if matches:
+                for match in matches:
+                    yield list(row) + match
+            elif self.how == "left":
+                yield list(row) + empty
+
+
+def get_column_index(columns, column):
+    for idx, col in enumerate(columns):
+        if col["label"] == column:
+            return idx
+    frappe.throw(f"Join column {column!r} not found in result")
+
+
+def escape_value(value):
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return str(value)
+    return frappe.db.escape(str(value))
+
+
+def get_table_sql(insights_table, db_table, column):
+    """sql reading the table of `insights_table`, after checking it has `column`"""
+    if not frappe.db.exists("Insights Table Column", {"parent": insights_table, "column": column}):
+        frappe.throw(f"Column {column} not found in table {insights_table}")
+    return f"select * from {quote(db_table)}"
+
+
+def get_build_table(insights_table):
+    """the Insights Table of the small side of a join, it must be on a single data source"""
+    table = frappe.db.get_value(
+        "Insights Table",
+        insights_table,
+        ["name", "table", "data_source", "is_query_based"],
+        as_dict=True,
+    )
+    if not table or table.is_query_based:
+        frappe.throw(f"Table {insights_table} not found", frappe.DoesNotExistError)
+    check_data_source_permission(table.data_source)
+    return table
+
+
+@frappe.whitelist()
+@check_role("Insights User")
+def run_broadcast_join(data_source, table, build_table, probe_key, build_key, how="inner"):
+    """
+    join an Insights Table of a composite data source, on every member, with a small
+    Insights Table of a single data source
+    """
+    check_data_source_permission(data_source)
+    data_source = frappe.get_doc("Insights Data Source", data_source)
+    if not data_source.composite_datasource:
+        frappe.throw("Broadcast joins are only available for composite data sources")
+    return data_source.db.broadcast_join(table, build_table, probe_key, build_key, how)
@@ -16,7 +16,10 @@ from insights_changes.overrides.functions import get_tables
 from insights_changes.overrides.functions.is_frappe_db import is_frappe_db
 from insights_changes.utils import (
     add_data_source_column_to_table_columns,
+    data_source_exists,
+    get_cached_virtual_table,
     get_columns_for_virtual_table,
+    set_cached_virtual_table,
     split_virtual_table_name,
     validate_no_cycle_in_sources,
 )
@@ -31,25 +34,49 @@ class CustomInsightsTable(InsightsTable):
 
         Name should be given as <regular-table-name::virtual-datasource>
             eg: tabNote::virtual_1
+
+        Resolved virtual tables are cached per schema version of the virtual data source
         """
 
         self.virtual_data_source = None
+        self.resolved_virtual_table = False
+        table_name = None
         if args and isinstance(args[0], str):
             name, to_replace = (args[0], 0) if len(args) == 1 else (args[1], 1)
             table_name, data_source = split_virtual_table_name(name)
-            if virtual := frappe.db.exists("Insights Data Source", data_source):
+            if virtual := data_source_exists(data_source):
                 # TODO: confirm the data source is part of a virtual data source
                 # this may not be necessary if tags are used to link sources in virtual data source
                 self.virtual_data_source = virtual
+                if cached := get_cached_virtual_table(table_name, virtual):
+                    self.resolved_virtual_table = True
+                    super().__init__(cached)
+                    self.flags.columns_for_virtual_table_gotten = True
+                    return
                 # load regular data source
                 args = (*args[:to_replace], table_name, *args[to_replace + 1 :])  # noqa: E203
+        elif args and isinstance(args[0], dict):
+            # as_dict of a virtual table (eg. from the document cache)
+            self.virtual_data_source = args[0].get("virtual_data_source")
+            self.resolved_virtual_table = bool(self.virtual_data_source)
 
         # call original init
         super().__init__(*args, **kwargs)
+        if self.resolved_virtual_table:
+            self.flags.columns_for_virtual_table_gotten = True
+
+        if self.virtual_data_source and table_name:
+            set_cached_virtual_table(table_name, self)
+
+    def as_dict(self, *args, **kwargs):
+        out = super().as_dict(*args, **kwargs)
+        if self.virtual_data_source:
+            out["virtual_data_source"] = self.virtual_data_source
+        return out
 
     def __setup__(self):
         """add `Data Source` column"""
-        if not self.virtual_data_source:
+        if not self.virtual_data_source or self.resolved_virtual_table:
             return
 
         # TODO: avoid saving this to database
@@ -82,8 +109,8 @@ class CustomInsightsTable(InsightsTable):
 class CustomInsightsDataSource(InsightsDataSource):
     """`Virtual InsightsTable`"""
 
-    def get_database(self):
-        conn_args = {
+    def get_connection_args(self):
+        return {
             "data_source": self.name,
             "host": self.host,
             "port": self.port,
@@ -93,6 +120,9 @@ class CustomInsightsDataSource(InsightsDataSource):
             "database_name": self.database_name,
         }
 
+    def get_database(self):
+        conn_args = self.get_connection_args()
+
         if is_frappe_db(conn_args):
             return FrappeDB(**conn_args)
 
@@ -1,5 +1,6 @@
 import frappe
 from frappe.desk.doctype.tag.tag import add_tag as add_tag_original
+from frappe.desk.doctype.tag.tag import remove_tag as remove_tag_original
 from insights.api import get_data_source as get_data_source_original
 from insights.decorators import check_role
 from insights.insights.doctype.insights_team.insights_team import (
@@ -7,6 +8,7 @@ from insights.insights.doctype.insights_team.insights_team import (
     get_permission_filter,
 )
 from insights_changes.utils import (
+    bump_virtual_schema_versions,
     get_sources_for_virtual,
     make_virtual_table_name,
     validate_no_cycle_in_sources,
@@ -114,6 +116,15 @@ def add_tag(tag, dt, dn, color=None):
     return out
 
 
+@frappe.whitelist()
+def remove_tag(tag, dt, dn):
+    out = remove_tag_original(tag, dt, dn)
+    if dt == "Insights Data Source":
+        # tag links are deleted without doc events
+        bump_virtual_schema_versions()
+    return out
+
+
 @frappe.whitelist()
 def get_queries_column(query_names):
     # TODO: handle permissions
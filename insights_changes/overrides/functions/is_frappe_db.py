@@ -7,6 +7,16 @@ class FrappeDBTest(FrappeDB):
         return self.engine.connect()
 
 
+def can_connect(db_params):
+    """open (and close) a connection to the database without going through the cache"""
+    try:
+        db = FrappeDBTest(**db_params)
+        with db.connect():
+            return True
+    except BaseException:
+        return False
+
+
 def is_frappe_db(db_params):
     def _is_frappe_db():
         try:
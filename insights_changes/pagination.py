@@ -0,0 +1,238 @@
+import base64
+import heapq
+import json
+
+import frappe
+from insights.cache_utils import make_digest
+
+DEFAULT_PAGE_LENGTH = 100
+
+
+class SortKey:
+    """orders rows by several keys with per-key direction, nulls first"""
+
+    __slots__ = ("values", "descending")
+
+    def __init__(self, values, descending):
+        self.values = values
+        self.descending = descending
+
+    def __lt__(self, other):
+        for a, b, desc in zip(self.values, other.values, self.descending):
+            if a == b:
+                continue
+            if a is None or b is None:
+                return (a is None) != desc
+            return (a > b) if desc else (a < b)
+        return False
+
+
+class KeysetPaginator:
+    """
+    Pages through a composite query without re-running the full fan-out
+
+    Every member source returns its next page from its own cursor position (last key seen
+    and how many rows with that key were already returned). The pages are merged on the
+    sort keys and the cursors of all sources are encoded in the continuation token.
+    Nulls sort first in ascending and last in descending order, like on MariaDB, and the
+    columns the query doesn't order on break ties so every row has one position. Columns a
+    member doesn't have are selected as nulls, the way its rows are aligned when merged.
+    """
+
+    def __init__(self, query, column_names, page_length=DEFAULT_PAGE_LENGTH, token=None):
+        self.query = query
+        self.column_names = column_names
+        self.page_length = int(page_length or DEFAULT_PAGE_LENGTH)
+        self.order_by = self.get_order_by()
+        self.digest = make_digest(
+            "keyset", query.name, [(c.column, c.order_by) for c in query.columns], query.filters
+        )
+        self.cursors = self.decode_token(token) if token else {}
+
+    def get_order_by(self):
+        order_by = [
+            (name, (col.get("order_by") or "").lower() == "desc")
+            for name, col in zip(self.column_names, self.query.columns)
+            if col.get("order_by") and name != "data_source"
+        ]
+        # without an explicit order, page on every column, with one the others break ties
+        ordered = {name for name, _ in order_by}
+        return order_by + [
+            (name, False)
+            for name in self.column_names
+            if name != "data_source" and name not in ordered
+        ]
+
+    def decode_token(self, token):
+        try:
+            data = json.loads(base64.urlsafe_b64decode(token.encode()).decode())
+        except Exception:
+            frappe.throw("Invalid page token")
+        if data.get("digest") != self.digest:
+            frappe.throw("Page token does not belong to this query, reload the results")
+        return data["sources"]
+
+    def encode_token(self):
+        data = {"digest": self.digest, "sources": self.cursors}
+        return base64.urlsafe_b64encode(frappe.as_json(data, indent=None).encode()).decode()
+
+    def is_exhausted(self, source):
+        return self.cursors.get(source, {}).get("done")
+
+    def get_page_sql(self, sql, source, columns=None):
+        """
+        `sql` restricted to the rows after the cursor of `source`, in key order
+
+        `columns` are the labels of the columns `sql` returns, if it misses some of the
+        query's
+        """
+        cursor = self.cursors.get(source) or {}
+        if columns is not None:
+            missing = [name for name, _ in self.order_by if name not in columns]
+            if missing:
+                nulls = ", ".join(f"NULL as {quote(name)}" for name in missing)
+                sql = f"select t.*, {nulls} from ({sql}) as t"
+
+        conditions = ""
+        if cursor.get("key") is not None:
+            # (k1 > v1) or (k1 = v1 and k2 > v2) or ... or (k1 = v1 and ... and kn = vn)
+            key = cursor["key"]
+            equal = [get_equal_term(name, value) for (name, _), value in zip(self.order_by, key)]
+            terms = []
+            for idx, (name, desc) in enumerate(self.order_by):
+                if after := get_after_term(name, desc, key[idx]):
+                    terms.append(" and ".join([*equal[:idx], after]))
+            terms.append(" and ".join(equal))
+            conditions = "where " + " or ".join(f"({term})" for term in terms)
+
+        order = ", ".join(get_order_term(name, desc) for name, desc in self.order_by)
+        limit = self.page_length + (cursor.get("dup") or 0)
+        return f"select * from ({sql}) as t {conditions} order by {order} limit {limit}"
+
+    def get_key(self, row):
+        return [row[self.column_names.index(name)] for name, _ in self.order_by]
+
+    def skip_seen(self, source, rows):
+        """drop the rows tied with the cursor key that were returned on earlier pages"""
+        cursor = self.cursors.get(source) or {}
+        dup = cursor.get("dup") or 0
+        key = cursor.get("key")
+        out = []
+        for row in rows:
+            if dup and key is not None and jsonable(self.get_key(row)) == key:
+                dup -= 1
+                continue
+            out.append(row)
+        return out
+
+    def merge(self, pages):
+        """
+        merge the sorted `pages` ({source: rows}) into one page and advance the cursors
+
+        returns the rows of the page
+        """
+        descending = [desc for _, desc in self.order_by]
+        streams = []
+        remaining = {}
+        for source, rows in pages.items():
+            rows = self.skip_seen(source, rows)
+            self.cursors.setdefault(source, {})
+            # fewer rows than asked for: the source has nothing after these
+            if len(rows) < self.page_length:
+                remaining[source] = len(rows)
+            streams.append(self.get_stream(source, rows, descending))
+
+        page = []
+        for _, source, row in heapq.merge(*streams, key=lambda item: item[0]):
+            if len(page) >= self.page_length:
+                break
+            page.append(row)
+            self.advance(source, row)
+            if source in remaining:
+                remaining[source] -= 1
+
+        for source, count in remaining.items():
+            if not count:
+                self.cursors[source]["done"] = True
+        return page
+
+    def get_stream(self, source, rows, descending):
+        for row in rows:
+            yield SortKey(self.get_key(row), descending), source, row
+
+    def advance(self, source, row):
+        cursor = self.cursors.setdefault(source, {})
+        key = jsonable(self.get_key(row))
+        if cursor.get("key") == key:
+            cursor["dup"] = (cursor.get("dup") or 0) + 1
+        else:
+            cursor["key"] = key
+            cursor["dup"] = 1
+
+    def has_more(self):
+        return any(not cursor.get("done") for cursor in self.cursors.values())
+
+
+def align_rows(result, column_names, data_source):
+    """rows of a member result in the order of `column_names`, missing columns as None"""
+    if not result:
+        return []
+    index = {col["label"]: idx for idx, col in enumerate(result[0])}
+    positions = [index.get(name) for name in column_names]
+    return [
+        [
+            data_source if name == "data_source" else (row[pos] if pos is not None else None)
+            for name, pos in zip(column_names, positions)
+        ]
+        for row in result[1:]
+    ]
+
+
+def quote(name):
+    return "`{}`".format(name.replace("`", "``"))
+
+
+def get_order_term(name, desc):
+    # nulls are ordered explicitly, not every database puts them where SortKey does
+    column = f"t.{quote(name)}"
+    if desc:
+        return f"{column} is null asc, {column} desc"
+    return f"{column} is null desc, {column} asc"
+
+
+def get_equal_term(name, value):
+    column = f"t.{quote(name)}"
+    if value is None:
+        return f"{column} is null"
+    return f"{column} = {escape_value(value)}"
+
+
+def get_after_term(name, desc, value):
+    """condition of the values of `name` ordered after `value`, None if there are none"""
+    column = f"t.{quote(name)}"
+    if value is None:
+        # nulls are first ascending, every value is after them, and last descending
+        return None if desc else f"{column} is not null"
+    if desc:
+        return f"({column} < {escape_value(value)} or {column} is null)"
+    return f"{column} > {escape_value(value)}"
+
+
+def escape_value(value):
+    return "NULL" if value is None else frappe.db.escape(str(value))
+
+
+def jsonable(values):
+    """key values as they round trip through the page token"""
+    return json.loads(frappe.as_json(values, indent=None))
+
+
+@frappe.whitelist()
+def get_query_page(query, page_length=DEFAULT_PAGE_LENGTH, page_token=None):
+    """a page of the results of a query on a composite data source"""
+    doc = frappe.get_doc("Insights Query", query)
+    doc.check_permission("read")
+    data_source = frappe.get_doc("Insights Data Source", doc.data_source)
+    if not data_source.composite_datasource:
+        frappe.throw("Keyset pagination is only available for composite data sources")
+    return data_source.db.run_query_page(doc, page_length, page_token)
@@ -0,0 +1,233 @@
+"""
+Cost based planning of the fan-out of composite queries
+
+The cost of a query on a member source is estimated from the row estimates of EXPLAIN,
+cached per compiled sql and member schema version. Estimates decide how many workers the
+fan-out uses, which member sources are run together on one worker, and whether the query
+is too expensive to run at all.
+"""
+
+import concurrent.futures
+import heapq
+import math
+
+import frappe
+from insights.cache_utils import make_digest
+from insights_changes.admission import Admission, admit
+from insights_changes.utils import RawCacheKey, get_schema_version
+
+ESTIMATE_CACHE_KEY = "insights_changes:row_estimates"
+ESTIMATE_CACHE_EXPIRY = 60 * 60
+EXPLAIN_CONCURRENCY = 8
+# fixed cost of a call to a member source, in seconds (connection, round trip, fetch)
+SOURCE_OVERHEAD = 0.01
+# cost of every row a member source examines, in seconds
+ROW_COST = 2e-7
+# rows assumed for members whose plan couldn't be explained
+UNKNOWN_ROWS = 100000
+# cached in place of the estimate of sql that couldn't be explained, so it isn't retried
+UNEXPLAINED = -1
+# work per worker below which another thread costs more than it saves, in seconds
+MIN_WORKER_COST = 0.05
+
+DEFAULT_LIMITS = {
+    # examined rows, summed over the member sources, above which a query is flagged
+    "composite_warn_rows": 10000000,
+    # examined rows above which a query is refused, 0 to never refuse
+    "composite_max_rows": 1000000000,
+}
+
+
+class QueryTooExpensiveError(frappe.ValidationError):
+    pass
+
+
+class FanOutPlan:
+    """estimated rows per member source and the resulting concurrency and batches"""
+
+    def __init__(self, source_docs, estimates, row_cap=None):
+        self.source_docs = source_docs
+        self.estimates = estimates
+        self.row_cap = row_cap
+        self.costs = {
+            doc.name: SOURCE_OVERHEAD + ROW_COST * self.get_rows(doc) for doc in source_docs
+        }
+        self.total_rows = sum(self.get_rows(doc) for doc in source_docs)
+        self.total_cost = sum(self.costs.values())
+        self.concurrency = self.get_concurrency()
+
+    def get_rows(self, source_doc):
+        rows = self.estimates.get(source_doc.name)
+        rows = UNKNOWN_ROWS if rows is None else rows
+        return min(rows, self.row_cap) if self.row_cap else rows
+
+    def get_concurrency(self):
+        """
+        workers worth starting, tiny queries run serially in the calling thread
+
+        the fan-out can't finish before its most expensive source, more workers than
+        needed to spread the rest of the work within that time are wasted
+        """
+        if not self.source_docs:
+            return 1
+        target = max(MIN_WORKER_COST, max(self.costs.values()))
+        workers = math.ceil(self.total_cost / target)
+        return max(min(workers, len(self.source_docs)), 1)
+
+    def get_batches(self, workers):
+        """
+        member sources split in `workers` batches of about the same cost
+
+        the most expensive sources are placed first, each on the least loaded batch
+        """
+        batches = [(0, idx, []) for idx in range(min(workers, len(self.source_docs)))]
+        for doc in sorted(self.source_docs, key=lambda d: self.costs[d.name], reverse=True):
+            cost, idx, batch = heapq.heappop(batches)
+            batch.append(doc)
+            heapq.heappush(batches, (cost + self.costs[doc.name], idx, batch))
+        return [batch for _, _, batch in sorted(batches, key=lambda b: b[1]) if batch]
+
+    def check(self):
+        """refuse queries over the row budget of the site, flag the ones close to it"""
+        limits = {
+            key: int(frappe.conf.get(key) or default) for key, default in DEFAULT_LIMITS.items()
+        }
+        max_rows = limits["composite_max_rows"]
+        if max_rows and self.total_rows > max_rows:
+            frappe.throw(
+                f"This query would examine about {self.total_rows:,} rows across the member "
+                f"data sources, more than the limit of {max_rows:,}. Add filters or use a "
+                "rollup.",
+                QueryTooExpensiveError,
+                title="Query Too Expensive",
+            )
+        if self.total_rows > limits["composite_warn_rows"]:
+            report_expensive_query(self.total_rows)
+
+
+def report_expensive_query(rows):
+    """flag the response of the current request, the query still runs"""
+    response = getattr(frappe.local, "response", None)
+    if response is not None:
+        response["composite_estimated_rows"] = max(
+            rows, response.get("composite_estimated_rows") or 0
+        )
+
+
+def get_estimate_cache_key(source_name):
+    return f"{ESTIMATE_CACHE_KEY}:{source_name}:{get_schema_version(source_name)}"
+
+
+def get_cached_estimate(source_doc, sql):
+    """cached rows of `sql`, UNEXPLAINED if it couldn't be explained, None if not cached"""
+    return frappe.cache().hget(get_estimate_cache_key(source_doc.name), make_digest(sql))
+
+
+def set_cached_estimate(source_doc, sql, rows):
+    key = get_estimate_cache_key(source_doc.name)
+    frappe.cache().hset(key, make_digest(sql), rows)
+    RawCacheKey(key).expire(ESTIMATE_CACHE_EXPIRY)
+
+
+def explain_rows(source_doc, sql):
+    """rows `sql` examines on `source_doc` according to EXPLAIN, None if unknown"""
+    try:
+        result = source_doc.db.execute_query(f"explain {sql}", return_columns=True)
+    except Exception:
+        return None
+
+    labels = [str(col.get("label")).lower() for col in result[0]] if result else []
+    if "rows" not in labels:
+        return None
+    rows_idx = labels.index("rows")
+    filtered_idx = labels.index("filtered") if "filtered" in labels else None
+
+    # nested loop joins: every table is read once per row of the tables before it
+    total = 1
+    for row in result[1:]:
+        rows = float(row[rows_idx] or 0)
+        if filtered_idx is not None and row[filtered_idx] is not None:
+            rows = rows * float(row[filtered_idx]) / 100
+        total *= max(rows, 1)
+    return int(total)
+
+
+def get_row_cap(query):
+    """
+    rows a member stops at, if the limit of `query` is pushed down to the members as is
+
+    only plain rows without ordering stop at the limit, aggregations and sorts have to
+    examine every row first
+    """
+    if not query.get("limit") or query.get("is_native_query"):
+        return None
+    for col in query.columns:
+        if col.get("aggregation") or col.get("order_by"):
+            return None
+    return int(query.limit)
+
+
+def get_estimates(source_docs, get_sql, get_cached_sql=None):
+    """
+    {source: examined rows} of the sql returned by `get_sql(source_doc)`
+
+    estimates of sql compiled before are looked up in the calling thread, the sources
+    left are compiled and explained within the admission budget, like the query itself
+    """
+    estimates = {}
+    missing = []
+    for doc in source_docs:
+        sql = get_cached_sql(doc) if get_cached_sql else None
+        rows = get_cached_estimate(doc, sql) if sql else None
+        if rows is None:
+            missing.append(doc)
+        else:
+            estimates[doc.name] = None if rows == UNEXPLAINED else rows
+    if not missing:
+        return estimates
+
+    def estimate(source_doc):
+        try:
+            sql = get_sql(source_doc)
+        except Exception:
+            # the query itself reports members that fail
+            return None
+        if not sql:
+            return None
+        if (rows := get_cached_estimate(source_doc, sql)) is None:
+            rows = explain_rows(source_doc, sql)
+            set_cached_estimate(source_doc, sql, UNEXPLAINED if rows is None else rows)
+        return None if rows == UNEXPLAINED else rows
+
+    site = str(frappe.local.site)
+
+    def estimate_in_thread(source_doc):
+        frappe.connect(site=site)
+        return estimate(source_doc)
+
+    with admit(Admission(), min(len(missing), EXPLAIN_CONCURRENCY)) as slots:
+        if slots == 1:
+            for doc in missing:
+                estimates[doc.name] = estimate(doc)
+            return estimates
+
+        with concurrent.futures.ThreadPoolExecutor(slots) as executor:
+            futures = {executor.submit(estimate_in_thread, doc): doc for doc in missing}
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    estimates[futures[future].name] = future.result()
+                except Exception:
+                    # unexplained sources are planned with the default estimate
+                    pass
+    return estimates
+
+
+def plan_fan_out(query, source_docs, get_sql, get_cached_sql=None):
+    """
+    plan the fan-out of `query`
+
+    `get_sql(source_doc)` returns its sql on a member, `get_cached_sql(source_doc)` the
+    sql if it's compiled already, without compiling it
+    """
+    estimates = get_estimates(source_docs, get_sql, get_cached_sql)
+    return FanOutPlan(source_docs, estimates, get_row_cap(query))
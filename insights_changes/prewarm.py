@@ -0,0 +1,182 @@
+"""
+Pre-warming of composite queries before they are needed
+
+Interactive runs of queries on composite data sources are counted per hour of the day.
+Ten minutes before the hour a query's usage starts, it's run in the background with the
+scheduled priority and its result is kept in the pre-warmed result cache, which
+VirtualDB.run_query answers from until it expires, no later than insights' own query
+results would. Warming stops once the time spent on member sources exceeds the load
+budget of the run.
+"""
+
+import time
+
+import frappe
+from frappe.utils import add_to_date, now_datetime
+from insights_changes.admission import SCHEDULED, AdmissionRejectedError, query_priority
+from insights_changes.utils import (
+    RawCacheKey,
+    get_query_digest,
+    get_schema_version,
+    suppress_errors,
+)
+
+ACCESS_CACHE_KEY = "insights_changes:query_access"
+# pre-warmed results are served until they are this old, or as long as insights caches
+# query results if that's shorter
+RESULT_EXPIRY = 45 * 60
+# minutes insights caches query results for when its settings don't say
+DEFAULT_QUERY_RESULT_EXPIRY = 10
+# opens in an hour, after decay, before a query is worth warming for that hour
+MIN_OPENS = 3
+# usage starts at an hour when the hour before it saw less than this share of its opens
+START_RATIO = 0.25
+MAX_QUERIES = 50
+# access counts are halved every day, recent habits weigh more than old ones
+DECAY = 0.5
+DEFAULT_LOAD_BUDGET = 300
+
+
+def get_result_cache_key(db, query):
+    version = get_schema_version(db.data_source)
+    digest = get_query_digest(query)
+    return f"insights_changes:prewarmed:{db.data_source}:{version}:{digest}"
+
+
+def get_result_expiry():
+    """seconds a pre-warmed result is served, never longer than insights keeps its results"""
+    minutes = frappe.db.get_single_value("Insights Settings", "query_result_expiry")
+    return min(RESULT_EXPIRY, int(minutes or DEFAULT_QUERY_RESULT_EXPIRY) * 60)
+
+
+def get_prewarmed_result(db, query):
+    if frappe.flags.prewarming_composite_queries or frappe.flags.skip_composite_result_caches:
+        return
+    return frappe.cache().get_value(get_result_cache_key(db, query))
+
+
+def record_access(query):
+    """count an interactive run of `query` in the current hour"""
+    if frappe.flags.prewarming_composite_queries or not query.name:
+        return
+    if getattr(frappe.local, "request", None) is None:
+        return
+    with suppress_errors():
+        RawCacheKey(ACCESS_CACHE_KEY).hincrbyfloat(f"{query.name}|{now_datetime().hour}", 1)
+
+
+def get_access_counts():
+    """{query: {hour: opens}}"""
+    counts = {}
+    for field, value in RawCacheKey(ACCESS_CACHE_KEY).get_counters().items():
+        query, hour = field.rsplit("|", 1)
+        counts.setdefault(query, {})[int(hour)] = value
+    return counts
+
+
+def get_queries_to_warm(hour):
+    """queries whose usage starts at `hour`, most opened first"""
+    candidates = []
+    for query, hours in get_access_counts().items():
+        opens = hours.get(hour, 0)
+        if opens >= MIN_OPENS and hours.get((hour - 1) % 24, 0) < opens * START_RATIO:
+            candidates.append((opens, query))
+    return [query for _, query in sorted(candidates, reverse=True)[:MAX_QUERIES]]
+
+
+def get_load_budget():
+    """seconds of member source time a pre-warming run can use"""
+    return float(frappe.conf.get("composite_prewarm_load_budget") or DEFAULT_LOAD_BUDGET)
+
+
+def warm_query(query_name):
+    """
+    run a query and cache its result as pre-warmed
+
+    returns the seconds spent on member sources, summed over the sources
+    """
+    doc = frappe.get_doc("Insights Query", query_name)
+    data_source = frappe.get_doc("Insights Data Source", doc.data_source)
+    if not data_source.composite_datasource:
+        return 0
+
+    db = data_source.db
+    response = frappe.local.response
+    response["composite_traces"] = []
+    frappe.flags.trace_composite_queries = True
+    frappe.flags.prewarming_composite_queries = True
+    try:
+        with query_priority(SCHEDULED):
+            result = db.run_query(doc)
+    finally:
+        frappe.flags.trace_composite_queries = False
+        frappe.flags.prewarming_composite_queries = False
+
+    if not db.unavailable_sources:
+        frappe.cache().set_value(
+            get_result_cache_key(db, doc), result, expires_in_sec=get_result_expiry()
+        )
+    return sum(
+        span["duration"]
+        for trace in response.pop("composite_traces", [])
+        for span in trace["spans"]
+        if span["stage"] == "execute"
+    )
+
+
+def warm_queries(query_names):
+    budget = get_load_budget()
+    spent = 0
+    started = time.monotonic()
+    for query_name in query_names:
+        if spent >= budget:
+            frappe.logger("insights_changes").info(
+                f"Pre-warming stopped after {spent:.1f}s of member source time"
+            )
+            break
+        try:
+            spent += warm_query(query_name)
+        except AdmissionRejectedError:
+            # members are busy, warming would only add to it
+            break
+        except Exception:
+            frappe.log_error(title=f"Failed to pre-warm Insights Query {query_name}")
+    return {"spent": spent, "duration": time.monotonic() - started}
+
+
+def prewarm_queries():
+    """warm the queries whose usage starts in the next hour, run at ten to every hour"""
+    hour = add_to_date(now_datetime(), hours=1).hour
+    if query_names := get_queries_to_warm(hour):
+        frappe.enqueue(
+            "insights_changes.prewarm.warm_queries", query_names=query_names, queue="long"
+        )
+
+
+def decay_access_stats():
+    counts = get_access_counts()
+    key = RawCacheKey(ACCESS_CACHE_KEY)
+    pipeline = key.pipeline()
+    pipeline.delete(key.name)
+    for query, hours in counts.items():
+        for hour, opens in hours.items():
+            if opens * DECAY >= 0.1:
+                pipeline.hset(key.name, f"{query}|{hour}", opens * DECAY)
+    pipeline.execute()
+
+
+@frappe.whitelist()
+def prewarm_data_source(data_source):
+    """warm the most used queries of a composite data source, after its members refreshed"""
+    frappe.only_for("System Manager")
+    if not (counts := get_access_counts()):
+        return
+    queries = frappe.get_all(
+        "Insights Query",
+        filters={"data_source": data_source, "name": ["in", list(counts)]},
+        pluck="name",
+    )
+    queries = sorted(queries, key=lambda q: sum(counts[q].values()), reverse=True)
+    frappe.enqueue(
+        "insights_changes.prewarm.warm_queries", query_names=queries[:MAX_QUERIES], queue="long"
+    )
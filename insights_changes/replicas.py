@@ -0,0 +1,130 @@
+import random
+import time
+from contextlib import contextmanager
+
+import frappe
+from insights_changes.handles import SourceHandle, get_source_handles
+from insights_changes.health import get_source_name, registry
+from insights_changes.utils import RawCacheKey
+
+INFLIGHT_CACHE_KEY = "insights_changes:replica_inflight"
+LATENCY_CACHE_KEY = "insights_changes:replica_latency"
+# weight of the latest call in the moving average of a source's latency
+LATENCY_ALPHA = 0.3
+# latency assumed for sources that haven't been used yet
+DEFAULT_LATENCY = 0.5
+# in-flight counters expire in case a worker dies before decrementing them
+INFLIGHT_EXPIRY = 10 * 60
+
+
+def get_replica_groups(sources):
+    """{source: replica group} for the member sources declared as replicas"""
+    if not sources:
+        return {}
+    if not all(isinstance(s, SourceHandle) for s in sources):
+        # names, or documents, are resolved through the cached handles
+        sources = get_source_handles([get_source_name(s) for s in sources])
+    return {handle.name: handle.replica_group for handle in sources if handle.replica_group}
+
+
+class ReplicaRouter:
+    """
+    Picks one member source per replica group for each query
+
+    Replicas are balanced by in-flight calls and recent latency, both shared by all
+    workers through redis, and a failed call can fail over to another replica.
+    """
+
+    def __init__(self):
+        self.groups = {}
+        self.labels = {}
+
+    def route(self, sources):
+        """one source per replica group, sources without a group are returned as is"""
+        sources = list(sources)
+        self.labels = get_replica_groups(sources)
+        if not self.labels:
+            return sources
+
+        self.groups = {}
+        routed = []
+        for source in sources:
+            group = self.labels.get(get_source_name(source))
+            if not group:
+                routed.append(source)
+            elif group not in self.groups:
+                self.groups[group] = [source]
+                # placeholder, the replica is chosen once the whole group is known
+                routed.append((group,))
+            else:
+                self.groups[group].append(source)
+
+        return [self.choose(s[0]) if isinstance(s, tuple) else s for s in routed]
+
+    def choose(self, group, exclude=()):
+        candidates = [
+            s
+            for s in self.groups.get(group, [])
+            if get_source_name(s) not in exclude and registry.is_available(get_source_name(s))
+        ]
+        if not candidates:
+            # let the health checks of the caller deal with a group that's entirely down
+            candidates = [
+                s for s in self.groups.get(group, []) if get_source_name(s) not in exclude
+            ]
+        if not candidates:
+            return None
+
+        inflight = self.get_inflight()
+        latency = frappe.cache().hgetall(LATENCY_CACHE_KEY) or {}
+
+        def score(source):
+            name = get_source_name(source)
+            return (inflight.get(name, 0) + 1) * latency.get(name, DEFAULT_LATENCY)
+
+        best = min(score(s) for s in candidates)
+        return random.choice([s for s in candidates if score(s) == best])
+
+    def get_label(self, source):
+        """`data_source` value of the rows of a source: its replica group, if any"""
+        name = get_source_name(source)
+        return self.labels.get(name) or name
+
+    def get_failover(self, source, tried):
+        """another replica of the group of `source`, as a document"""
+        group = self.labels.get(get_source_name(source))
+        if not group:
+            return None
+        replica = self.choose(group, exclude=tried)
+        if replica is None:
+            return None
+        if isinstance(replica, str):
+            return frappe.get_doc("Insights Data Source", replica)
+        return replica
+
+    def get_inflight(self):
+        counters = RawCacheKey(INFLIGHT_CACHE_KEY).get_counters(int)
+        return {name: max(count, 0) for name, count in counters.items()}
+
+    @contextmanager
+    def track(self, source_name):
+        """count the call as in-flight and update the latency of the source when done"""
+        if source_name not in self.labels:
+            yield
+            return
+
+        inflight = RawCacheKey(INFLIGHT_CACHE_KEY)
+        inflight.hincrby(source_name, 1)
+        inflight.expire(INFLIGHT_EXPIRY)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            inflight.hincrby(source_name, -1)
+            self.record_latency(source_name, time.perf_counter() - start)
+
+    def record_latency(self, source_name, duration):
+        previous = frappe.cache().hget(LATENCY_CACHE_KEY, source_name)
+        if previous is not None:
+            duration = LATENCY_ALPHA * duration + (1 - LATENCY_ALPHA) * previous
+        frappe.cache().hset(LATENCY_CACHE_KEY, source_name, duration)
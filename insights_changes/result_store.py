@@ -0,0 +1,460 @@
+"""
+Shared store of large composite query results
+
+With `composite_result_store` set in site config, merged results of VirtualDB.run_query
+with more than SMALL_MERGE_ROWS rows are written once to a columnar file under
+private/insights_changes/results, and every worker of the site serves them from a
+read-only memory map of that file until they expire. The pages of a file are shared by
+all the workers mapping it, so a result opened by many users is held once per node
+instead of once per worker.
+
+Entries are tracked in redis: their metadata, the last time they were served (for LRU
+eviction under `composite_result_store_max_bytes`) and a lease for every request reading
+them, entries in use are only evicted once they expire. Maps are closed when the request
+that opened them ends, and leases expire unless they're renewed while the map is read, so
+a worker that dies mid-response doesn't keep its entry in use.
+
+File layout: magic, header length, JSON header, then one block per column. Integer and
+float columns are stored as native arrays with an optional null mask, text columns as
+dictionary indices, anything else (dates, decimals, mixed types) pickled in chunks of
+rows. The binary endpoints stream stored results straight from the map, see wire.py.
+"""
+
+import json
+import mmap
+import os
+import pickle
+import struct
+import threading
+import time
+from array import array
+
+import frappe
+from insights.cache_utils import make_digest
+from insights_changes.utils import (
+    SMALL_MERGE_ROWS,
+    RawCacheKey,
+    dictionary_encode,
+    get_query_digest,
+    get_schema_version,
+    suppress_errors,
+)
+
+ENTRIES_CACHE_KEY = "insights_changes:result_store"
+LRU_CACHE_KEY = "insights_changes:result_store:lru"
+LEASES_CACHE_KEY = "insights_changes:result_store:leases"
+MAGIC = b"ICR1"
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024
+DEFAULT_TTL = 10 * 60
+# seconds a lease on an entry lasts without being renewed
+LEASE_TTL = 60
+# rows per pickled chunk of a column
+CHUNK_ROWS = 10000
+
+
+def is_store_enabled():
+    return bool(frappe.conf.get("composite_result_store"))
+
+
+def get_max_bytes():
+    return int(frappe.conf.get("composite_result_store_max_bytes") or DEFAULT_MAX_BYTES)
+
+
+def get_ttl():
+    return int(frappe.conf.get("composite_result_store_ttl") or DEFAULT_TTL)
+
+
+def get_store_path(*parts):
+    return frappe.get_site_path("private", "insights_changes", "results", *parts)
+
+
+def get_store_key(db, query):
+    version = get_schema_version(db.data_source)
+    digest = get_query_digest(query)
+    return f"{db.data_source}:{version}:{digest}"
+
+
+def align(offset):
+    return offset + (-offset % 8)
+
+
+def encode_column(values):
+    """(block, {chunk: bytes}) of a column, null masks have a byte per row"""
+    kinds = {type(v) for v in values if v is not None}
+    nulls = {"nulls": bytes(v is None for v in values)} if None in values else {}
+    try:
+        if kinds <= {int}:
+            data = array("q", [v or 0 for v in values]).tobytes()
+            return {"kind": "q"}, {"data": data, **nulls}
+        if kinds <= {float}:
+            data = array("d", [v or 0.0 for v in values]).tobytes()
+            return {"kind": "d"}, {"data": data, **nulls}
+    except OverflowError:
+        pass
+    if kinds <= {str}:
+        # None is a dictionary value, text columns need no null mask
+        dictionary, indices = dictionary_encode(values)
+        return {"kind": "dict"}, {
+            "dictionary": json.dumps(dictionary).encode(),
+            "data": array("i", indices).tobytes(),
+        }
+    # pickled in chunks, so a range of rows can be read without unpickling the whole column
+    chunks = [
+        pickle.dumps(values[start : start + CHUNK_ROWS], protocol=pickle.HIGHEST_PROTOCOL)
+        for start in range(0, len(values), CHUNK_ROWS)
+    ]
+    return {"kind": "pickle", "types": sorted(kind.__name__ for kind in kinds)}, {"data": chunks}
+
+
+def write_result(path, result):
+    """write a `[columns] + rows` result to `path`, returns the size of the file"""
+    columns = result[0]
+    rows = result[1:]
+    # merged rows can start with their data source, which the columns don't have
+    width = len(rows[0]) if rows else len(columns)
+    blocks = []
+    chunks = []
+    offset = 0
+
+    def add_chunk(data):
+        nonlocal offset
+        start = offset
+        chunks.append((start, data))
+        offset = align(offset + len(data))
+        return [start, len(data)]
+
+    for idx in range(width):
+        block, data = encode_column([row[idx] for row in rows])
+        for name, chunk in data.items():
+            if isinstance(chunk, list):
+                block[name] = [add_chunk(c) for c in chunk]
+            else:
+                block[name] = add_chunk(chunk)
+        blocks.append(block)
+
+    header = json.dumps(
+        {"rows": len(rows), "chunk_rows": CHUNK_ROWS, "columns": columns, "blocks": blocks}
+    ).encode()
+    start = align(len(MAGIC) + 4 + len(header))
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(MAGIC + struct.pack("<I", len(header)) + header)
+        for chunk_offset, data in chunks:
+            f.seek(start + chunk_offset)
+            f.write(data)
+        f.truncate(start + offset)
+    # readers only ever see complete files
+    os.replace(tmp_path, path)
+    return start + offset
+
+
+class StoredResult:
+    """
+    read-only memory map of a stored result
+
+    values are read a range of rows at a time, numeric columns and the indices of text
+    columns can be read as buffers of the map itself, without copying them
+    """
+
+    def __init__(self, path, key=None):
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[: len(MAGIC)] != MAGIC:
+            self.map.close()
+            raise ValueError(f"Not a stored result: {path}")
+
+        (length,) = struct.unpack_from("<I", self.map, len(MAGIC))
+        header_start = len(MAGIC) + 4
+        header = json.loads(self.map[header_start : header_start + length])
+        self.start = align(header_start + length)
+        self.rows = header["rows"]
+        self.chunk_rows = header["chunk_rows"]
+        self.columns = header["columns"]
+        self.blocks = header["blocks"]
+        self.width = len(self.blocks)
+        self.dictionaries = {}
+        self.closed = False
+
+        # entries under lease are not evicted; the key of the leases is resolved now, the map
+        # can be closed after the request that opened it
+        self.lease = f"{key}|{frappe.generate_hash(length=12)}" if key else None
+        if self.lease:
+            self.leases = RawCacheKey(LEASES_CACHE_KEY)
+            self.renewed = 0
+            self.renew_lease()
+
+    def __len__(self):
+        return self.rows
+
+    def renew_lease(self):
+        now = time.time()
+        if self.lease and now - self.renewed >= LEASE_TTL / 3:
+            self.renewed = now
+            self.leases.zadd({self.lease: now + LEASE_TTL})
+
+    def get_range(self, start, stop):
+        # every read goes through here, long responses keep their lease
+        self.renew_lease()
+        stop = self.rows if stop is None else min(stop, self.rows)
+        return start, max(start, stop)
+
+    def read(self, chunk, fn, start=0, stop=None):
+        """`fn` of the bytes `start:stop` of a chunk, read in place"""
+        offset, length = chunk
+        stop = length if stop is None else min(stop, length)
+        offset += self.start
+        with memoryview(self.map) as view, view[offset + start : offset + stop] as data:
+            return fn(data)
+
+    def get_kind(self, idx):
+        return self.blocks[idx]["kind"]
+
+    def has_nulls(self, idx):
+        return bool(self.blocks[idx].get("nulls"))
+
+    def get_buffer(self, idx, start=0, stop=None):
+        """
+        rows `start:stop` of a numeric column, or the dictionary indices of a text column, as
+        a memoryview of the map; null rows of numeric columns read as 0
+        """
+        start, stop = self.get_range(start, stop)
+        block = self.blocks[idx]
+        itemsize = 4 if block["kind"] == "dict" else 8
+        offset = self.start + block["data"][0]
+        return memoryview(self.map)[offset + start * itemsize : offset + stop * itemsize]
+
+    def get_dictionary(self, idx):
+        if idx not in self.dictionaries:
+            chunk = self.blocks[idx]["dictionary"]
+            self.dictionaries[idx] = self.read(chunk, lambda data: json.loads(bytes(data)))
+        return self.dictionaries[idx]
+
+    def get_indices(self, idx, start=0, stop=None):
+        start, stop = self.get_range(start, stop)
+        chunk = self.blocks[idx]["data"]
+        return self.read(chunk, lambda data: data.cast("i").tolist(), start * 4, stop * 4)
+
+    def get_values(self, idx, start=0, stop=None):
+        """values of rows `start:stop` of a column"""
+        start, stop = self.get_range(start, stop)
+        block = self.blocks[idx]
+        kind = block["kind"]
+        if kind in ("q", "d"):
+            values = self.read(
+                block["data"], lambda data: data.cast(kind).tolist(), start * 8, stop * 8
+            )
+        elif kind == "dict":
+            dictionary = self.get_dictionary(idx)
+            values = [dictionary[i] for i in self.get_indices(idx, start, stop)]
+        else:
+            values = []
+            first, last = start // self.chunk_rows, -(-stop // self.chunk_rows)
+            for chunk_idx in range(first, last):
+                chunk_start = chunk_idx * self.chunk_rows
+                chunk = self.read(block["data"][chunk_idx], pickle.loads)
+                values += chunk[max(start - chunk_start, 0) : stop - chunk_start]
+
+        if block.get("nulls"):
+            nulls = self.read(block["nulls"], bytes, start, stop)
+            values = [None if null else value for value, null in zip(values, nulls)]
+        return values
+
+    def iter_rows(self, batch_rows=None):
+        """rows of the result, read `batch_rows` at a time"""
+        batch_rows = batch_rows or self.chunk_rows
+        for start in range(0, self.rows, batch_rows):
+            stop = start + batch_rows
+            columns = [self.get_values(idx, start, stop) for idx in range(self.width)]
+            yield from map(list, zip(*columns))
+
+    def to_result(self):
+        return [self.columns, *self.iter_rows()]
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.lease:
+            self.leases.zrem(self.lease)
+        try:
+            self.map.close()
+        except BufferError:
+            # buffers of the map are still in use, it's unmapped once they're collected
+            pass
+
+
+def get_entry(key):
+    entry = frappe.cache().hget(ENTRIES_CACHE_KEY, key)
+    if entry and time.time() - entry["created"] < get_ttl():
+        return entry
+
+
+def map_result(path, key=None):
+    """StoredResult of the file at `path`, None if it was evicted since it was looked up"""
+    try:
+        return StoredResult(path, key)
+    except FileNotFoundError:
+        return
+
+
+def skip_store():
+    """results are computed again while prewarming, and always when benchmarking"""
+    return (
+        not is_store_enabled()
+        or frappe.flags.prewarming_composite_queries
+        or frappe.flags.skip_composite_result_caches
+    )
+
+
+def find_result(db, query):
+    """(key, entry) of the stored result of `query`, entry is None if there is none"""
+    key = get_store_key(db, query)
+    entry = get_entry(key)
+    if entry:
+        RawCacheKey(LRU_CACHE_KEY).zadd({key: time.time()})
+    return key, entry
+
+
+def get_stored_result(db, query):
+    """
+    stored result of `query` on a composite data source, or None
+
+    this is the result of the JSON endpoints, every row is read from the map into a list,
+    only the binary endpoints serve stored results without building them in memory
+    """
+    if skip_store():
+        return
+
+    with suppress_errors("Failed to read stored composite result"):
+        key, entry = find_result(db, query)
+        if entry and (stored := map_result(entry["path"], key)):
+            try:
+                return stored.to_result()
+            finally:
+                stored.close()
+
+
+def open_stored_result(db, query):
+    """
+    stored result of `query` mapped for a single response, or None
+
+    the map is not shared with other requests, it stays open while the response is streamed
+    and the caller closes it
+    """
+    if skip_store():
+        return
+
+    with suppress_errors("Failed to read stored composite result"):
+        key, entry = find_result(db, query)
+        if entry:
+            return map_result(entry["path"], key)
+
+
+def store_result(db, query, result):
+    """store a large merged result of `query`, so any worker can serve it"""
+    if not is_store_enabled() or frappe.flags.skip_composite_result_caches:
+        return
+    if len(result) - 1 <= SMALL_MERGE_ROWS:
+        return
+
+    with suppress_errors("Failed to store composite result"):
+        key = get_store_key(db, query)
+        path = get_store_path(f"{make_digest(key)}.icr")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        size = write_result(path, result)
+        if size > get_max_bytes():
+            os.remove(path)
+            return
+
+        created = time.time()
+        frappe.cache().hset(
+            ENTRIES_CACHE_KEY,
+            key,
+            {"path": path, "size": size, "rows": len(result) - 1, "created": created},
+        )
+        RawCacheKey(LRU_CACHE_KEY).zadd({key: created})
+        evict_results()
+
+
+def remove_entry(key, entry=None):
+    cache = frappe.cache()
+    entry = entry or cache.hget(ENTRIES_CACHE_KEY, key)
+    cache.hdel(ENTRIES_CACHE_KEY, key)
+    RawCacheKey(LRU_CACHE_KEY).zrem(key)
+    # workers that still have the file mapped keep reading it until they close it
+    if entry:
+        remove_file(entry["path"])
+
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def get_entries():
+    return frappe.cache().hgetall(ENTRIES_CACHE_KEY) or {}
+
+
+def evict_results():
+    """remove expired results, then the least recently served until the store fits its cap"""
+    entries = get_entries()
+    ttl = get_ttl()
+    now = time.time()
+    for key, entry in list(entries.items()):
+        if now - entry["created"] >= ttl:
+            remove_entry(key, entries.pop(key))
+
+    total = sum(entry["size"] for entry in entries.values())
+    max_bytes = get_max_bytes()
+    if total <= max_bytes:
+        return
+
+    in_use = get_leased_keys()
+    lru = RawCacheKey(LRU_CACHE_KEY).zrange(0, -1)
+    for key in map(frappe.safe_decode, lru):
+        if total <= max_bytes:
+            break
+        if key not in entries or key in in_use:
+            continue
+        total -= entries[key]["size"]
+        remove_entry(key, entries.pop(key))
+
+
+def get_leased_keys():
+    """keys of the entries read by a request right now, expired leases are dropped"""
+    leases = RawCacheKey(LEASES_CACHE_KEY)
+    leases.zremrangebyscore(0, time.time())
+    return {frappe.safe_decode(lease).rsplit("|", 1)[0] for lease in leases.zrange(0, -1)}
+
+
+def remove_orphan_files():
+    """remove files of results no longer in the store, once no worker could still open them"""
+    directory = get_store_path()
+    if not os.path.isdir(directory):
+        return
+    paths = {entry["path"] for entry in get_entries().values()}
+    cutoff = time.time() - get_ttl()
+    for filename in os.listdir(directory):
+        path = os.path.join(directory, filename)
+        if path not in paths and os.path.getmtime(path) < cutoff:
+            remove_file(path)
+
+
+def cleanup_result_store():
+    """evict expired results and remove orphaned files, run hourly"""
+    if is_store_enabled() or os.path.isdir(get_store_path()):
+        evict_results()
+        remove_orphan_files()
+
+
+def clear_result_store():
+    """remove every stored result"""
+    for key, entry in get_entries().items():
+        remove_entry(key, entry)
+
+    directory = get_store_path()
+    if os.path.isdir(directory):
+        for filename in os.listdir(directory):
+            remove_file(os.path.join(directory, filename))
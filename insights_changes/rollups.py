@@ -0,0 +1,84 @@
+from datetime import timedelta
+
+import frappe
+from frappe.utils import getdate
+
+TIME_GRAINS = ("Day", "Week", "Month", "Quarter", "Year")
+
+
+def get_rollups(data_source, tables):
+    return frappe.get_all(
+        "Insights Rollup",
+        filters={"data_source": data_source, "table": ["in", tables], "enabled": 1},
+        pluck="name",
+    )
+
+
+def answer_from_rollups(db, query):
+    """answer `query` on the virtual data source of `db` from a matching rollup, if any"""
+    tables = [row.table for row in query.tables]
+    if not tables or not (rollups := get_rollups(db.data_source, tables)):
+        return
+
+    source_names = [
+        db.get_source_label(source) for source in db.get_source_docs(get_docs=False, query=query)
+    ]
+    for rollup in rollups:
+        doc = frappe.get_cached_doc("Insights Rollup", rollup)
+        result = doc.answer(query, source_names)
+        if result is not None:
+            return result
+
+
+def refresh_rollups(refresh_interval):
+    for rollup in frappe.get_all(
+        "Insights Rollup",
+        filters={"enabled": 1, "refresh_interval": refresh_interval},
+        pluck="name",
+    ):
+        try:
+            frappe.get_doc("Insights Rollup", rollup).refresh()
+            frappe.db.commit()
+        except Exception:
+            frappe.db.rollback()
+            frappe.log_error(title=f"Failed to refresh Insights Rollup {rollup}")
+
+
+def refresh_hourly_rollups():
+    refresh_rollups("Hourly")
+
+
+def refresh_daily_rollups():
+    refresh_rollups("Daily")
+
+
+def get_date_format(column):
+    format_option = frappe.parse_json(column.get("format_option") or "{}") or {}
+    return (format_option.get("date_format") or "").title()
+
+
+def truncate_date(value, grain):
+    if value is None:
+        return None
+    value = getdate(value)
+    if grain == "Week":
+        return value - timedelta(days=value.weekday())
+    if grain == "Month":
+        return value.replace(day=1)
+    if grain == "Quarter":
+        return value.replace(month=(value.month - 1) // 3 * 3 + 1, day=1)
+    if grain == "Year":
+        return value.replace(month=1, day=1)
+    return value
+
+
+def sort_rows(rows, columns):
+    # stable sorts, least significant column first
+    for idx in reversed(range(len(columns))):
+        order = (columns[idx].get("order_by") or "").lower()
+        if order in ("asc", "desc"):
+            rows.sort(
+                key=lambda row: (row[idx] is not None, row[idx]),
+                reverse=order == "desc",
+            )
+    return rows
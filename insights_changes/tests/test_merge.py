@@ -0,0 +1,68 @@
+import unittest
+
+import frappe
+from insights_changes.utils import (
+    DistinctRows,
+    merge_large_query_results,
+    merge_small_query_results,
+)
+
+
+def make_query(*columns):
+    return frappe._dict(
+        columns=[frappe._dict(column=column, label=label) for column, label in columns]
+    )
+
+
+def make_result(labels, *rows):
+    return [[{"label": label} for label in labels], *map(list, rows)]
+
+
+# the second member has its columns in another order and misses Region, the third
+# returns no rows at all
+RESULTS = [
+    ("member_a", make_result(["Name", "Qty", "Region"], ["a", 1, "EU"], ["b", None, None])),
+    ("member_b", make_result(["Qty", "Name"], [2, "c"], [None, "a"], [1, "a"])),
+    ("member_c", make_result(["Name", "Qty", "Region"])),
+]
+
+
+class TestMergeQueryResults(unittest.TestCase):
+    def assertSamePaths(self, query, results, distinct=False):
+        small_distinct = DistinctRows() if distinct else None
+        large_distinct = DistinctRows() if distinct else None
+        small = merge_small_query_results(results, query, distinct=small_distinct)
+        large = merge_large_query_results(results, query, distinct=large_distinct)
+        self.assertEqual(small, large)
+        # same values, not just equal ones: 1 == 1.0, but the pandas path must not widen ints
+        self.assertEqual(repr(small), repr(large))
+        if distinct:
+            self.assertEqual(small_distinct.removed, large_distinct.removed)
+        return small
+
+    def test_drifted_members(self):
+        query = make_query(("name", "Name"), ("qty", "Qty"), ("region", "Region"))
+        merged = self.assertSamePaths(query, RESULTS)
+        self.assertEqual(
+            merged[1:],
+            [["a", 1, "EU"], ["b", None, None], ["c", 2, None], ["a", None, None], ["a", 1, None]],
+        )
+
+    def test_drifted_members_with_data_source(self):
+        query = make_query(
+            ("data_source", "Data Source"), ("name", "Name"), ("qty", "Qty"), ("region", "Region")
+        )
+        merged = self.assertSamePaths(query, RESULTS)
+        self.assertEqual([row[0] for row in merged[1:]], ["member_a"] * 2 + ["member_b"] * 3)
+
+    def test_distinct_drifted_members(self):
+        results = RESULTS + [("member_d", make_result(["Name", "Qty"], ["c", 2], ["a", 1]))]
+        query = make_query(("name", "Name"), ("qty", "Qty"), ("region", "Region"))
+        merged = self.assertSamePaths(query, results, distinct=True)
+        self.assertEqual(len(merged) - 1, 5)
+
+        query = make_query(
+            ("data_source", "Data Source"), ("name", "Name"), ("qty", "Qty"), ("region", "Region")
+        )
+        merged = self.assertSamePaths(query, results, distinct=True)
+        self.assertEqual(len(merged) - 1, 7)
@@ -0,0 +1,82 @@
+import random
+import sqlite3
+import unittest
+
+import frappe
+from insights_changes.pagination import KeysetPaginator, align_rows
+
+MEMBERS = ("member_a", "member_b")
+
+
+def make_query(*columns):
+    return frappe._dict(
+        name="Test Query",
+        filters=None,
+        columns=[
+            frappe._dict(column=column, label=column, order_by=order_by)
+            for column, order_by in columns
+        ],
+    )
+
+
+class TestKeysetPagination(unittest.TestCase):
+    def setUp(self):
+        rand = random.Random(1)
+        self.connection = sqlite3.connect(":memory:")
+        for member in MEMBERS:
+            self.connection.execute(f"create table {member} (qty numeric, region numeric)")
+            # nulls and repeated keys on both columns
+            self.connection.executemany(
+                f"insert into {member} values (?, ?)",
+                [(rand.choice([None, 1, 2]), rand.choice([None, 1, 2, 3])) for _ in range(40)],
+            )
+
+    def tearDown(self):
+        self.connection.close()
+
+    def read_all_pages(self, query, member_sql, page_length=7):
+        column_names = [col.column for col in query.columns]
+        rows = []
+        token = None
+        for _ in range(100):
+            paginator = KeysetPaginator(query, column_names, page_length, token)
+            pages = {}
+            for member, (sql, columns) in member_sql.items():
+                if paginator.is_exhausted(member):
+                    continue
+                cursor = self.connection.execute(paginator.get_page_sql(sql, member, columns))
+                result = [[{"label": d[0]} for d in cursor.description]]
+                result += [list(row) for row in cursor.fetchall()]
+                pages[member] = align_rows(result, column_names, member)
+            rows += paginator.merge(pages)
+            if not paginator.has_more():
+                return rows
+            token = paginator.encode_token()
+        self.fail("pagination did not finish")
+
+    def test_every_row_once_with_nulls_and_ties(self):
+        member_sql = {member: (f"select * from {member}", None) for member in MEMBERS}
+        expected = sorted(
+            repr(list(row))
+            for member in MEMBERS
+            for row in self.connection.execute(f"select * from {member}")
+        )
+        for order_by in (None, "asc", "desc"):
+            query = make_query(("qty", order_by), ("region", None))
+            rows = self.read_all_pages(query, member_sql)
+            self.assertEqual(sorted(map(repr, rows)), expected, order_by)
+
+    def test_member_without_a_column(self):
+        # the second member has no region, its rows page on nulls in its place
+        member_sql = {
+            "member_a": ("select qty, region from member_a", None),
+            "member_b": ("select qty from member_b", ["qty"]),
+        }
+        expected = sorted(
+            [repr(list(row)) for row in self.connection.execute("select * from member_a")]
+            + [repr([row[0], None]) for row in self.connection.execute("select * from member_b")]
+        )
+        for order_by in (None, "desc"):
+            query = make_query(("qty", None), ("region", order_by))
+            rows = self.read_all_pages(query, member_sql)
+            self.assertEqual(sorted(map(repr, rows)), expected, order_by)
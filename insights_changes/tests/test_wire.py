@@ -0,0 +1,43 @@
+import unittest
+
+import frappe
+from insights_changes.utils import dictionary_encode
+from insights_changes.wire import get_result_columns, to_columns
+
+
+def make_query(*columns):
+    return frappe._dict(
+        columns=[
+            frappe._dict(column=column, label=label, type="String") for column, label in columns
+        ]
+    )
+
+
+class TestWire(unittest.TestCase):
+    def test_data_source_column_of_merged_result(self):
+        query = make_query(("name", "Name"), ("data_source", "Data Source"), ("qty", "Qty"))
+        # merged rows start with the data source, the columns are the first member's
+        result = [
+            [{"label": "Name", "type": "String"}, {"label": "Qty", "type": "Integer"}],
+            ["Source A", "Item 1", 2],
+            ["Source B", "Item 2", 3],
+        ]
+
+        labels, columns = to_columns([get_result_columns(result, query), *result[1:]])
+        self.assertEqual(labels, ["Data Source", "Name", "Qty"])
+        self.assertEqual(columns, [["Source A", "Source B"], ["Item 1", "Item 2"], [2, 3]])
+        self.assertEqual(dictionary_encode(columns[0]), (["Source A", "Source B"], [0, 1]))
+
+    def test_columns_of_result_without_data_source(self):
+        query = make_query(("name", "Name"), ("qty", "Qty"))
+        result = [
+            [{"label": "Name", "type": "String"}, {"label": "Qty", "type": "Integer"}],
+            ["Item 1", 2],
+        ]
+        self.assertEqual(get_result_columns(result, query), result[0])
+
+    def test_columns_follow_query_when_members_disagree(self):
+        query = make_query(("name", "Name"), ("data_source", "Data Source"), ("qty", "Qty"))
+        result = [[{"label": "Name", "type": "String"}], ["Item 1", "Source A", None]]
+        labels = [col["label"] for col in get_result_columns(result, query)]
+        self.assertEqual(labels, ["Name", "data_source", "Qty"])
@@ -0,0 +1,176 @@
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+import frappe
+from insights_changes.utils import RawCacheKey, suppress_errors
+from werkzeug.wrappers import Response
+
+METRICS_CACHE_KEY = "insights_changes:metrics"
+SIZE_SAMPLE_ROWS = 100
+
+
+class QueryTrace:
+    """spans of a single composite query, recorded from the request and the fan-out threads"""
+
+    def __init__(self, operation, data_source):
+        self.operation = operation
+        self.data_source = data_source
+        self.started = time.perf_counter()
+        self.duration = None
+        self.error = None
+        self.spans = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, stage, source=None):
+        span = frappe._dict(stage=stage, source=source, rows=None, bytes=None)
+        start = time.perf_counter()
+        try:
+            yield span
+        except Exception:
+            span.error = True
+            raise
+        finally:
+            span.duration = time.perf_counter() - start
+            with self._lock:
+                self.spans.append(span)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # failed operations are recorded too, whatever stage they failed in
+        if exc_type is not None:
+            self.error = exc_type.__name__
+        self.finish()
+
+    def finish(self):
+        if self.duration is not None:
+            return self
+        self.duration = time.perf_counter() - self.started
+        record_metrics(self)
+        if should_attach_trace():
+            attach_trace(self)
+        return self
+
+    def as_dict(self):
+        return {
+            "operation": self.operation,
+            "data_source": self.data_source,
+            "duration": self.duration,
+            "error": self.error,
+            "spans": [dict(span) for span in self.spans],
+        }
+
+
+def get_result_size(result):
+    """rows and approximate bytes of a result, with or without a columns row"""
+    rows = result or []
+    if rows and rows[0] and isinstance(rows[0], (list, tuple)) and isinstance(rows[0][0], dict):
+        rows = rows[1:]
+    if not rows:
+        return 0, 0
+
+    # estimate from a sample, sizing every value of large results is too slow
+    sample = rows[:SIZE_SAMPLE_ROWS]
+    size = sum(
+        sys.getsizeof(value)
+        for row in sample
+        for value in (row if isinstance(row, (list, tuple)) else (row,))
+    )
+    return len(rows), int(size * len(rows) / len(sample))
+
+
+def should_attach_trace():
+    form_dict = getattr(frappe.local, "form_dict", None) or {}
+    return bool(frappe.flags.trace_composite_queries or form_dict.get("trace_composite"))
+
+
+def attach_trace(trace):
+    response = getattr(frappe.local, "response", None)
+    if response is None:
+        return
+    response.setdefault("composite_traces", []).append(trace.as_dict())
+
+
+def record_metrics(trace):
+    """add the spans of `trace` to the counters shared by all workers"""
+    counters = {}
+
+    def add(name, value):
+        if value:
+            counters[name] = counters.get(name, 0) + value
+
+    add(f"queries|{trace.operation}|{trace.data_source}|", 1)
+    add(f"query_seconds|{trace.operation}|{trace.data_source}|", trace.duration)
+    add(f"query_errors|{trace.operation}|{trace.data_source}|", 1 if trace.error else 0)
+    for span in trace.spans:
+        labels = f"{span.stage}|{trace.data_source}|{span.source or ''}"
+        add(f"spans|{labels}", 1)
+        add(f"span_seconds|{labels}", span.duration)
+        add(f"span_rows|{labels}", span.rows)
+        add(f"span_bytes|{labels}", span.bytes)
+        add(f"span_errors|{labels}", 1 if span.get("error") else 0)
+
+    with suppress_errors():
+        key = RawCacheKey(METRICS_CACHE_KEY)
+        pipeline = key.pipeline()
+        for name, value in counters.items():
+            pipeline.hincrbyfloat(key.name, name, value)
+        pipeline.execute()
+
+
+def get_metrics():
+    return RawCacheKey(METRICS_CACHE_KEY).get_counters()
+
+
+def format_prometheus(counters):
+    help_texts = {
+        "queries": "Composite queries run",
+        "query_seconds": "Total duration of composite queries",
+        "query_errors": "Composite queries that raised an error",
+        "spans": "Composite query spans, by stage and member source",
+        "span_seconds": "Total duration of composite query spans",
+        "span_rows": "Rows handled by composite query spans",
+        "span_bytes": "Approximate bytes handled by composite query spans",
+        "span_errors": "Composite query spans that raised an error",
+    }
+    lines = []
+    by_metric = {}
+    for name, value in sorted(counters.items()):
+        metric, *labels = name.split("|")
+        by_metric.setdefault(metric, []).append((labels, value))
+
+    for metric, samples in by_metric.items():
+        prom_name = f"insights_composite_{metric}_total"
+        lines.append(f"# HELP {prom_name} {help_texts.get(metric, metric)}")
+        lines.append(f"# TYPE {prom_name} counter")
+        for labels, value in samples:
+            if metric in ("queries", "query_seconds", "query_errors"):
+                names = ("operation", "data_source")
+            else:
+                names = ("stage", "data_source", "source")
+            label_str = ",".join(
+                f'{n}="{escape_label(v)}"' for n, v in zip(names, labels) if v
+            )
+            lines.append(f"{prom_name}{{{label_str}}} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def escape_label(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+@frappe.whitelist()
+def metrics():
+    """composite query metrics in the Prometheus text format"""
+    frappe.only_for("System Manager")
+    return Response(format_prometheus(get_metrics()), mimetype="text/plain; version=0.0.4")
+
+
+@frappe.whitelist()
+def reset_metrics():
+    frappe.only_for("System Manager")
+    frappe.cache().delete_value(METRICS_CACHE_KEY)
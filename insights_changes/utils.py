@@ -1,8 +1,119 @@
+import functools
+import hashlib
 import json
 import operator
+from contextlib import contextmanager
 
 import frappe
-import pandas as pd
+import redis
+from frappe.utils import today
+from insights_changes.pagination import align_rows, quote
+
+SCHEMA_VERSION_CACHE_KEY = "insights_changes:schema_version"
+DATA_SOURCE_EXISTS_CACHE_KEY = "insights_changes:data_source_exists"
+VIRTUAL_TABLE_CACHE_EXPIRY = 24 * 60 * 60
+COMPILED_SQL_CACHE_EXPIRY = 24 * 60 * 60
+# merges of up to this many rows are done with plain lists, pandas only pays off above it
+SMALL_MERGE_ROWS = 20000
+# filter functions whose sql depends on the current date
+DATE_FUNCTIONS = {"timespan", "within", "is_within", "start_of", "today", "now", "time_elapsed"}
+
+
+class RawCacheKey:
+    """
+    redis key of plain values (counters, sorted sets) that RedisWrapper would pickle
+
+    redis commands are called without the key, e.g. `RawCacheKey(KEY).hincrby(field, 1)`.
+    The site prefix of the key is resolved when it's created, it can be used after the
+    request that created it
+    """
+
+    def __init__(self, key):
+        self.cache = frappe.cache()
+        self.name = self.cache.make_key(key)
+
+    def __getattr__(self, command):
+        return functools.partial(getattr(redis.Redis, command), self.cache, self.name)
+
+    def pipeline(self):
+        return self.cache.pipeline()
+
+    def get_counters(self, cast=float):
+        """{field: value} of a hash of counters"""
+        return {frappe.safe_decode(k): cast(v) for k, v in (self.hgetall() or {}).items()}
+
+
+@contextmanager
+def suppress_errors(title=None):
+    """
+    run the bookkeeping of a query (metrics, stats, caches), which must never fail it
+
+    errors are logged with `title`, or ignored without one
+    """
+    try:
+        yield
+    except Exception:
+        if title:
+            frappe.log_error(title=title)
+
+
+def get_schema_version(data_source):
+    """opaque token that changes whenever the synced tables of `data_source` change"""
+    version = frappe.cache().hget(SCHEMA_VERSION_CACHE_KEY, data_source)
+    if not version:
+        version = bump_schema_version(data_source)
+    return version
+
+
+def bump_schema_version(*data_sources):
+    version = frappe.generate_hash(length=10)
+    for data_source in data_sources:
+        frappe.cache().hset(SCHEMA_VERSION_CACHE_KEY, data_source, version)
+    return version
+
+
+def bump_virtual_schema_versions():
+    """invalidate the merged schema of every composite data source"""
+    if virtual_sources := frappe.get_all(
+        "Insights Data Source", filters={"composite_datasource": 1}, pluck="name"
+    ):
+        bump_schema_version(*virtual_sources)
+
+
+def data_source_exists(data_source):
+    if not data_source:
+        return None
+
+    exists = frappe.cache().hget(DATA_SOURCE_EXISTS_CACHE_KEY, data_source)
+    if exists is None:
+        exists = bool(frappe.db.exists("Insights Data Source", data_source))
+        frappe.cache().hset(DATA_SOURCE_EXISTS_CACHE_KEY, data_source, exists)
+    return data_source if exists else None
+
+
+def clear_data_source_exists_cache(data_source=None):
+    if data_source:
+        frappe.cache().hdel(DATA_SOURCE_EXISTS_CACHE_KEY, data_source)
+    else:
+        frappe.cache().delete_value(DATA_SOURCE_EXISTS_CACHE_KEY)
+
+
+def get_virtual_table_cache_key(table_name, virtual_data_source):
+    version = get_schema_version(virtual_data_source)
+    return f"insights_changes:virtual_table:{virtual_data_source}:{version}:{table_name}"
+
+
+def get_cached_virtual_table(table_name, virtual_data_source):
+    """resolved virtual `Insights Table` as a dict, if cached for the current schema version"""
+    return frappe.cache().get_value(get_virtual_table_cache_key(table_name, virtual_data_source))
+
+
+def set_cached_virtual_table(table_name, virtual_table):
+    frappe.cache().set_value(
+        get_virtual_table_cache_key(table_name, virtual_table.virtual_data_source),
+        virtual_table.as_dict(),
+        expires_in_sec=VIRTUAL_TABLE_CACHE_EXPIRY,
+    )
 
 
 def make_virtual_table_name(table_name, virtual_data_source_name):
@@ -131,12 +242,7 @@ def add_data_source_column_to_table_columns(virtual_table):
     return virtual_table
 
 
-def set_table_columns_for_df(data_frame, table_name, virtual_data_source):
-    # get columns for table
-    virtual_table = frappe.get_doc(
-        "Insights Table", make_virtual_table_name(table_name, virtual_data_source)
-    )
-    column_names = [col.column for col in virtual_table.columns]
+def set_table_columns_for_df(data_frame, column_names):
     df_column_names = set(data_frame.columns)
     for col_name in column_names:
         if col_name not in df_column_names:
@@ -145,7 +251,62 @@ def set_table_columns_for_df(data_frame, table_name, virtual_data_source):
     return data_frame[column_names]
 
 
-def merge_query_results(results, query_doc, base_query_doc=None):
+def merge_query_results(results, query_doc, base_query_doc=None, distinct=None):
+    """
+    rows of the member `results` aligned on the columns of the query
+
+    with `distinct`, a DistinctRows, rows seen before are left out as they are merged
+    """
+    rows = sum(len(result) - 1 for _, result in results if result)
+    if rows <= SMALL_MERGE_ROWS:
+        return merge_small_query_results(results, query_doc, base_query_doc, distinct)
+    return merge_large_query_results(results, query_doc, base_query_doc, distinct)
+
+
+def merge_small_query_results(results, query_doc, base_query_doc=None, distinct=None):
+    """merge_query_results with plain lists, missing values are None instead of NaN"""
+    include_data_source = any(
+        col.column == "data_source" for col in (base_query_doc or query_doc).columns
+    )
+    first_columns = []
+    names = []
+    sources = []
+    for data_source, result in results:
+        if not (result and result[0] and isinstance(result[0][0], dict)):
+            continue
+        columns = result[0]
+        if not first_columns:
+            first_columns = columns
+
+        index = {col["label"]: idx for idx, col in enumerate(columns)}
+        if include_data_source:
+            lowercase = first_columns[0]["label"].islower()
+            # -1 stands for the data source of the row
+            index = {"data_source" if lowercase else "Data Source": -1, **index}
+        names += [name for name in index if name not in names]
+        rows = result[1:] if any(len(row) for row in result[1:]) else []
+        sources.append((data_source, index, rows))
+
+    # columns of the query that no source returned are added, in the order of the query
+    lowercase = first_columns and first_columns[0]["label"].islower()
+    colnames = [row.column if lowercase else row.label for row in query_doc.columns]
+    if any(name not in names for name in colnames):
+        names = colnames
+
+    merged = []
+    for data_source, index, rows in sources:
+        positions = [index.get(name) for name in names]
+        aligned = (
+            [None if pos is None else data_source if pos < 0 else row[pos] for pos in positions]
+            for row in rows
+        )
+        merged += aligned if distinct is None else filter(distinct.is_new, aligned)
+    return [first_columns] + merged
+
+
+def merge_large_query_results(results, query_doc, base_query_doc=None, distinct=None):
+    import pandas as pd
+
     include_data_source = False
     for col in (base_query_doc or query_doc).columns:
         if col.column == "data_source":
@@ -155,6 +316,12 @@ def merge_query_results(results, query_doc, base_query_doc=None):
     first_columns = []
     df = pd.DataFrame()
 
+    def get_row_key(data_source, labels, row):
+        # members can return the columns in another order, rows are compared by column
+        values = [(label, value) for label, value in zip(labels, row) if value is not None]
+        key = sorted(values, key=lambda item: item[0])
+        return [data_source if include_data_source else None, *key]
+
     def is_lowercase_columns():
         return first_columns and first_columns[0]["label"].islower()
 
@@ -167,7 +334,12 @@ def merge_query_results(results, query_doc, base_query_doc=None):
 
         data = result[1:] if any(len(row) for row in result[1:]) else []
         df_columns = [col["label"] for col in columns]
-        new_df = pd.DataFrame(data, columns=df_columns)
+        if distinct is not None:
+            data = [
+                row for row in data if distinct.is_new(get_row_key(data_source, df_columns, row))
+            ]
+        # object columns keep the values as the members returned them, ints aren't widened
+        new_df = pd.DataFrame(data, columns=df_columns, dtype=object)
         if include_data_source:
             data_source_col = "data_source" if is_lowercase_columns() else "Data Source"
             new_df.insert(0, data_source_col, data_source)
@@ -185,9 +357,192 @@ def merge_query_results(results, query_doc, base_query_doc=None):
     if added_col:
         df = df[colnames]
 
+    # values missing from a member are NaN after the concat, they merge as None like above
+    df = df.astype(object).where(df.notna(), None)
     return [first_columns] + df.to_numpy().tolist()
 
 
+def dictionary_encode(values):
+    """(dictionary, indices) of `values`, in the order values first appear"""
+    dictionary = {}
+    indices = [dictionary.setdefault(value, len(dictionary)) for value in values]
+    return list(dictionary), indices
+
+
+class DistinctRows:
+    """
+    Recognizes rows merged before, for distinct merges
+
+    only a digest of every row is kept, not the row itself
+    """
+
+    def __init__(self):
+        self.seen = set()
+        self.removed = 0
+
+    def is_new(self, row):
+        digest = hashlib.blake2b(repr(tuple(row)).encode(), digest_size=16).digest()
+        if digest in self.seen:
+            self.removed += 1
+            return False
+        self.seen.add(digest)
+        return True
+
+
+def get_distinct_sql(sql, query, columns):
+    """
+    distinct rows of `sql`, a query on a member returning the `columns` labels
+
+    databases ignore the order of a derived table without a limit, the order of the query
+    is applied to the outer select again
+    """
+    order_by = [
+        f"t.{quote(col.label)} {col.order_by.lower()}"
+        for col in query.columns
+        if (col.get("order_by") or "").lower() in ("asc", "desc") and col.label in columns
+    ]
+    sql = f"select distinct * from ({sql}) as t"
+    return f"{sql} order by {', '.join(order_by)}" if order_by else sql
+
+
+def report_duplicates_removed(count):
+    """add the duplicate rows removed by a distinct merge to the response of the request"""
+    response = getattr(frappe.local, "response", None)
+    if not count or response is None:
+        return
+    response["composite_duplicates_removed"] = (
+        response.get("composite_duplicates_removed") or 0
+    ) + count
+
+
+def merge_execute_results(results, pluck=False, return_columns=False):
+    """
+    merge the results of one sql statement run on several sources
+
+    `results` is a list of (data_source, result). Rows get the data source as their first
+    value, plucked values are concatenated. With `return_columns`, rows are aligned by
+    column label like in run_query, columns missing on a source are None.
+    """
+    if pluck:
+        return [value for _, result in results for value in result or []]
+
+    if not return_columns:
+        return [[data_source, *row] for data_source, result in results for row in result or []]
+
+    columns = {}
+    for _, result in results:
+        for col in result[0] if result else []:
+            columns.setdefault(col["label"], col)
+    if not columns:
+        return []
+
+    names = ["data_source", *columns]
+    rows = []
+    for data_source, result in results:
+        rows.extend(align_rows(result, names, data_source))
+    return [[{"label": "data_source", "type": "String"}, *columns.values()]] + rows
+
+
+def get_called_functions(query):
+    """names of the functions and operators used in the filters and expressions of `query`"""
+    names = set()
+
+    def walk(node):
+        if isinstance(node, dict):
+            for key in ("function", "operator"):
+                if isinstance(node.get(key), str):
+                    names.add(node[key].lower())
+            nodes = node.values()
+        elif isinstance(node, list):
+            nodes = node
+        else:
+            return
+        for child in nodes:
+            walk(child)
+
+    for value in (query.filters, *(col.get("expression") for col in query.columns or [])):
+        try:
+            walk(frappe.parse_json(value) if isinstance(value, str) else value)
+        except ValueError:
+            continue
+    return names
+
+
+def get_referenced_queries(query):
+    """{name: modified} of the queries `query` selects from, their sql is inlined in its sql"""
+    referenced = {}
+    tables = {row.table for row in query.tables or [] if row.get("table")}
+    while tables:
+        found = frappe.get_all(
+            "Insights Query", filters={"name": ["in", list(tables)]}, fields=["name", "modified"]
+        )
+        referenced.update({row.name: str(row.modified) for row in found})
+        tables = set()
+        if found:
+            tables = set(
+                frappe.get_all(
+                    "Insights Query Table",
+                    filters={"parent": ["in", [row.name for row in found]]},
+                    pluck="table",
+                )
+            ).difference(referenced)
+    return referenced
+
+
+def get_query_definition(query):
+    """
+    everything the sql of `query` is built from, as plain values
+
+    relative date filters are turned into dates and query based tables into the sql of
+    their query when the sql is built, so the date and the versions of the referenced
+    queries are part of the definition too
+    """
+
+    def get_values(rows):
+        return [
+            row.as_dict(no_default_fields=True) if hasattr(row, "as_dict") else dict(row)
+            for row in rows or []
+        ]
+
+    return {
+        "name": query.name,
+        "tables": get_values(query.tables),
+        "columns": get_values(query.columns),
+        "filters": query.filters,
+        "limit": query.get("limit"),
+        "is_native_query": query.get("is_native_query"),
+        "sql": query.get("sql"),
+        "distinct_merge": query.get("distinct_merge"),
+        "date": today() if get_called_functions(query) & DATE_FUNCTIONS else None,
+        "referenced_queries": get_referenced_queries(query),
+    }
+
+
+def get_query_digest(query, *args):
+    """digest of everything the sql of `query` is built from"""
+    from insights.cache_utils import make_digest
+
+    return make_digest(*get_query_definition(query).values(), *args)
+
+
+def get_compiled_sql_cache_key(digest, data_source):
+    version = get_schema_version(data_source)
+    return f"insights_changes:compiled_sql:{data_source}:{version}:{digest}"
+
+
+def get_compiled_sql(digest, data_source):
+    """sql of the query with `digest` on `data_source`, if compiled for its current schema"""
+    return frappe.cache().get_value(get_compiled_sql_cache_key(digest, data_source))
+
+
+def set_compiled_sql(digest, data_source, sql):
+    frappe.cache().set_value(
+        get_compiled_sql_cache_key(digest, data_source),
+        sql,
+        expires_in_sec=COMPILED_SQL_CACHE_EXPIRY,
+    )
+
+
 def query_with_columns_in_table(query, data_source_name):
     """create a new query containing only the columns available in the data source"""
     query_str = """SELECT tc.column,t.table
@@ -274,7 +629,7 @@ def compare(val1, condition, val2, fieldtype=None):
     return ret
 
 
-def apply_query_filters_for_datasource(sources, query):
+def apply_query_filters_for_datasource(sources, query, get_label=None):
     from insights.insights.doctype.insights_dashboard.utils import (
         convert_into_simple_filter,
     )
@@ -291,7 +646,9 @@ def apply_query_filters_for_datasource(sources, query):
     if related:
         for source in sources:
             val = source
-            if isinstance(source, frappe.model.document.Document):
+            if get_label:
+                val = get_label(source)
+            elif not isinstance(source, str):
                 val = source.name
             for row in related:
                 if compare(val, row["operator"], row["value"]):
@@ -0,0 +1,333 @@
+"""
+Binary formats for composite query results
+
+Large composite results are expensive to send as JSON, these endpoints return them as an
+Arrow IPC stream (when pyarrow is installed) or as columnar MessagePack, gzip compressed
+while they are streamed. In both formats the `data_source` column is dictionary encoded.
+Results held in the result store are streamed from its memory map a batch at a time, the
+numeric columns of Arrow batches are buffers of the map.
+"""
+
+import datetime
+import decimal
+import io
+import zlib
+
+import frappe
+from insights_changes.admission import EXPORT, query_priority
+from insights_changes.result_store import StoredResult, open_stored_result
+from insights_changes.utils import dictionary_encode
+from werkzeug.wrappers import Response
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+ARROW_MIMETYPE = "application/vnd.apache.arrow.stream"
+MSGPACK_MIMETYPE = "application/vnd.msgpack"
+FORMATS = {"arrow": ARROW_MIMETYPE, "msgpack": MSGPACK_MIMETYPE}
+DATA_SOURCE_COLUMNS = ("data_source", "Data Source")
+BATCH_ROWS = 10000
+
+
+def get_available_formats():
+    return [
+        name
+        for name, module in (("arrow", pyarrow), ("msgpack", msgpack))
+        if module is not None
+    ]
+
+
+def get_format(requested=None):
+    """`requested` format, or the best one the client accepts"""
+    available = get_available_formats()
+    if not available:
+        frappe.throw("Install pyarrow or msgpack to download results in a binary format")
+
+    if requested:
+        if requested not in FORMATS:
+            frappe.throw(f"Unknown format: {requested}")
+        if requested not in available:
+            frappe.throw(f"The {requested} format is not available on this site")
+        return requested
+
+    accept = frappe.get_request_header("Accept") or ""
+    for name in available:
+        if FORMATS[name] in accept:
+            return name
+    return available[0]
+
+
+def to_columns(result):
+    """column labels and per-column values of a `[columns] + rows` result"""
+    if not result:
+        return [], []
+    labels = [col["label"] for col in result[0]]
+    rows = result[1:]
+    return labels, [[row[idx] for row in rows] for idx in range(len(labels))]
+
+
+def get_result_columns(result, query):
+    """
+    columns matching the rows of a merged query result
+
+    the rows of a merged result start with their data source when the query selects it,
+    its columns are the ones the first member returned, without the data source
+    """
+    columns = result[0] if result else []
+    width = len(result[1]) if len(result) > 1 else len(columns)
+    return match_columns(columns, width, query)
+
+
+def match_columns(columns, width, query):
+    """`columns` of a merged result with rows of `width` values"""
+    if width == len(columns):
+        return columns
+    if width == len(columns) + 1:
+        lowercase = bool(columns) and columns[0]["label"].islower()
+        label = DATA_SOURCE_COLUMNS[0] if lowercase else DATA_SOURCE_COLUMNS[1]
+        return [{"label": label, "type": "String"}, *columns]
+    # members disagreed on the columns, rows follow the columns of the query
+    return [
+        {
+            "label": DATA_SOURCE_COLUMNS[0] if col.column == "data_source" else col.label,
+            "type": col.type,
+        }
+        for col in query.columns
+    ]
+
+
+def encode_value(value):
+    if isinstance(value, (datetime.date, datetime.datetime, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, datetime.timedelta):
+        return str(value)
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    return value
+
+
+def iter_arrow(result):
+    labels, columns = to_columns(result)
+    arrays = []
+    for label, values in zip(labels, columns):
+        if label in DATA_SOURCE_COLUMNS:
+            dictionary, indices = dictionary_encode(values)
+            arrays.append(
+                pyarrow.DictionaryArray.from_arrays(
+                    pyarrow.array(indices, type=pyarrow.int32()), pyarrow.array(dictionary)
+                )
+            )
+            continue
+        try:
+            arrays.append(pyarrow.array(values))
+        except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError, OverflowError):
+            # mixed types across member sources, send them as text
+            arrays.append(
+                pyarrow.array([None if v is None else str(encode_value(v)) for v in values])
+            )
+
+    table = pyarrow.Table.from_arrays(arrays, names=labels)
+    sink = io.BytesIO()
+    with pyarrow.ipc.new_stream(sink, table.schema) as writer:
+        for batch in table.to_batches(max_chunksize=BATCH_ROWS):
+            writer.write_batch(batch)
+            yield drain(sink)
+    yield drain(sink)
+
+
+def get_arrow_type(stored, idx, label):
+    kind = stored.get_kind(idx)
+    if kind == "q":
+        return pyarrow.int64()
+    if kind == "d":
+        return pyarrow.float64()
+    if kind == "dict":
+        if label in DATA_SOURCE_COLUMNS:
+            return pyarrow.dictionary(pyarrow.int32(), pyarrow.string())
+        return pyarrow.string()
+
+    # pickled columns, by the types of their values
+    types = tuple(stored.blocks[idx]["types"])
+    return {
+        ("bool",): pyarrow.bool_(),
+        ("date",): pyarrow.date32(),
+        ("datetime",): pyarrow.timestamp("us"),
+        ("time",): pyarrow.time64("us"),
+        ("timedelta",): pyarrow.duration("us"),
+        ("Decimal",): pyarrow.float64(),
+        ("Decimal", "float"): pyarrow.float64(),
+        ("float", "int"): pyarrow.float64(),
+    }.get(types, pyarrow.string())
+
+
+def get_arrow_array(stored, idx, start, stop, type, dictionary=None):
+    """rows `start:stop` of a column of a stored result, numeric columns are not copied"""
+    length = stop - start
+    kind = stored.get_kind(idx)
+    if kind in ("q", "d") and not stored.has_nulls(idx):
+        data = pyarrow.py_buffer(stored.get_buffer(idx, start, stop))
+        return pyarrow.Array.from_buffers(type, length, [None, data])
+    if dictionary is not None:
+        indices = pyarrow.py_buffer(stored.get_buffer(idx, start, stop))
+        return pyarrow.DictionaryArray.from_arrays(
+            pyarrow.Array.from_buffers(pyarrow.int32(), length, [None, indices]), dictionary
+        )
+
+    values = stored.get_values(idx, start, stop)
+    if type == pyarrow.string():
+        values = [None if v is None else str(encode_value(v)) for v in values]
+    elif type == pyarrow.float64():
+        values = [None if v is None else float(v) for v in values]
+    return pyarrow.array(values, type=type)
+
+
+def iter_stored_arrow(stored):
+    """Arrow IPC stream of a stored result, read from its map a batch at a time"""
+    labels = [col["label"] for col in stored.columns]
+    types = [get_arrow_type(stored, idx, label) for idx, label in enumerate(labels)]
+    dictionaries = {
+        idx: pyarrow.array(stored.get_dictionary(idx), type=pyarrow.string())
+        for idx, type in enumerate(types)
+        if pyarrow.types.is_dictionary(type)
+    }
+    schema = pyarrow.schema(list(zip(labels, types)))
+    sink = io.BytesIO()
+    with pyarrow.ipc.new_stream(sink, schema) as writer:
+        for start in range(0, len(stored), BATCH_ROWS):
+            stop = min(start + BATCH_ROWS, len(stored))
+            arrays = [
+                get_arrow_array(stored, idx, start, stop, type, dictionaries.get(idx))
+                for idx, type in enumerate(types)
+            ]
+            writer.write_batch(pyarrow.RecordBatch.from_arrays(arrays, schema=schema))
+            yield drain(sink)
+    yield drain(sink)
+
+
+def drain(sink):
+    """bytes written to `sink` so far, the sink is emptied"""
+    data = sink.getvalue()
+    sink.seek(0)
+    sink.truncate()
+    return data
+
+
+def iter_msgpack(result):
+    """
+    columnar MessagePack: a header map followed by one map per batch of rows
+
+    header: {"columns": [{"label", "type"}], "dictionaries": {label: [values]}}
+    batch: {"length": n, "data": [[values of column 1], ...]}
+    """
+    labels, columns = to_columns(result)
+    packer = msgpack.Packer(default=encode_value)
+    dictionaries = {}
+    for idx, label in enumerate(labels):
+        if label in DATA_SOURCE_COLUMNS:
+            dictionaries[label], columns[idx] = dictionary_encode(columns[idx])
+
+    yield packer.pack({"columns": result[0] if result else [], "dictionaries": dictionaries})
+    length = len(columns[0]) if columns else 0
+    for start in range(0, length, BATCH_ROWS):
+        batch = [values[start : start + BATCH_ROWS] for values in columns]
+        yield packer.pack({"length": len(batch[0]), "data": batch})
+
+
+def iter_stored_msgpack(stored):
+    """columnar MessagePack of a stored result, read from its map a batch at a time"""
+    packer = msgpack.Packer(default=encode_value)
+    dictionaries = {}
+    # {column: {value: index}} of data source columns that aren't stored dictionary encoded
+    encoders = {}
+    for idx, col in enumerate(stored.columns):
+        if col["label"] not in DATA_SOURCE_COLUMNS:
+            continue
+        if stored.get_kind(idx) == "dict":
+            dictionaries[col["label"]] = stored.get_dictionary(idx)
+        else:
+            dictionaries[col["label"]], _ = dictionary_encode(stored.get_values(idx))
+            encoders[idx] = {value: i for i, value in enumerate(dictionaries[col["label"]])}
+
+    yield packer.pack({"columns": stored.columns, "dictionaries": dictionaries})
+    data_source_columns = [col["label"] in DATA_SOURCE_COLUMNS for col in stored.columns]
+    for start in range(0, len(stored), BATCH_ROWS):
+        stop = min(start + BATCH_ROWS, len(stored))
+        batch = []
+        for idx, is_data_source in enumerate(data_source_columns):
+            if idx in encoders:
+                encoder = encoders[idx]
+                batch.append([encoder[v] for v in stored.get_values(idx, start, stop)])
+            elif is_data_source:
+                batch.append(stored.get_indices(idx, start, stop))
+            else:
+                batch.append(stored.get_values(idx, start, stop))
+        yield packer.pack({"length": stop - start, "data": batch})
+
+
+def gzip_stream(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    for chunk in chunks:
+        if chunk and (compressed := compressor.compress(chunk)):
+            yield compressed
+    yield compressor.flush()
+
+
+def make_response(result, format=None, filename="results"):
+    """streamed response of a `[columns] + rows` result or of a StoredResult"""
+    format = get_format(format)
+    if isinstance(result, StoredResult):
+        chunks = iter_stored_arrow(result) if format == "arrow" else iter_stored_msgpack(result)
+    else:
+        chunks = iter_arrow(result) if format == "arrow" else iter_msgpack(result)
+    extension = "arrow" if format == "arrow" else "msgpack"
+
+    headers = {"Content-Disposition": f'attachment; filename="{filename}.{extension}"'}
+    if "gzip" in (frappe.get_request_header("Accept-Encoding") or ""):
+        chunks = gzip_stream(chunks)
+        headers["Content-Encoding"] = "gzip"
+    response = Response(chunks, mimetype=FORMATS[format], headers=headers, direct_passthrough=True)
+    if isinstance(result, StoredResult):
+        response.call_on_close(result.close)
+    return response
+
+
+def get_composite_data_source(name):
+    data_source = frappe.get_doc("Insights Data Source", name)
+    if not data_source.composite_datasource:
+        frappe.throw("Binary results are only available for composite data sources")
+    return data_source
+
+
+@frappe.whitelist()
+def get_query_results(query, format=None):
+    """results of a query on a composite data source, as a binary stream"""
+    doc = frappe.get_doc("Insights Query", query)
+    doc.check_permission("read")
+    data_source = get_composite_data_source(doc.data_source)
+    # large results another worker stored are streamed from the shared map, not rebuilt
+    if stored := open_stored_result(data_source.db, doc):
+        stored.columns = match_columns(stored.columns, stored.width, doc)
+        return make_response(stored, format, frappe.scrub(doc.name))
+
+    with query_priority(EXPORT):
+        result = data_source.db.run_query(doc)
+    if result:
+        result = [get_result_columns(result, doc), *result[1:]]
+    return make_response(result, format, frappe.scrub(doc.name))
+
+
+@frappe.whitelist()
+def get_table_preview(data_source, table, limit=100, format=None):
+    """preview of a table of a composite data source, as a binary stream"""
+    frappe.has_permission("Insights Data Source", "read", data_source, throw=True)
+    data_source = get_composite_data_source(data_source)
+    with query_priority(EXPORT):
+        preview = data_source.db.get_insights_table_preview(table, int(limit), serialize=False)
+    return make_response(preview["data"], format, frappe.scrub(table))